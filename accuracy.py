@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+
+"""Accuracy of marker tracking against ground truth
+
+    Runs frames through TrackBlobs and TrackMarkers and scores the tracked
+    markers against the true markers of each frame:
+
+    detectionRate: fraction of true marker frames with a tracked marker
+        within matchDistance of the true center
+    idAccuracy: fraction of matched frames with a fixed ID where the ID is correct
+    lockRate: fraction of true markers which got their correct ID fixed
+    framesToLock: frames from the first frame until the correct ID was fixed
+    centerError: distance between tracked and true centers (pixels)
+    rotationError: angle between tracked and true rotation once the ID is fixed (degrees)
+
+    Frame times are reported alongside, so a faster stage can be checked for
+    not trading away accuracy.
+
+    Usage
+    -----
+    python accuracy.py --markers 1 2 3 --noise 0 0.5 --output accuracy.json
+    python accuracy.py --compare accuracy.json
+    python accuracy.py --recording session.fsr --truth truth.json
+
+    The truth file of a recording is a JSON list of markers
+    ({"ID": 3, "pos": [x, y], "rot": 1.2}) which stay in place during the
+    recording, or a {"frames": [[marker, ...], ...]} object with the markers
+    of every frame. "rot" is optional.
+"""
+
+from __future__ import print_function
+
+import argparse
+import itertools
+import json
+import sys
+import time
+
+import numpy as np
+
+import circular
+import forcestamp
+import synthetic
+
+RADII = [55 / 2 / 1.25, 17 / 1.25, 20.0, 16 / 1.25]
+
+
+def matchMarkers(truth, tracked, matchDistance=5):
+    # tracked marker nearest to each true marker, None when none is close enough
+    matches = []
+    used = set()
+    for t in truth:
+        best = None
+        bestDist = matchDistance
+        for i, mkr in enumerate(tracked):
+            if i in used:
+                continue
+            d = forcestamp.distance(t.pos, mkr.pos)
+            if d < bestDist:
+                best = i
+                bestDist = d
+        if best is not None:
+            used.add(best)
+        matches.append(None if best is None else tracked[best])
+    return matches
+
+
+def score(frames, truths, radii=RADII, matchDistance=5):
+    """Track frames and score the markers against ground truth
+
+    Args
+    ----
+    frames (iterable:array): force frames
+    truths (iterable:list): true markers of each frame, objects with ID, pos
+        and optionally rot (synthetic.SyntheticMarker)
+    radii (list:float): marker radii of TrackMarkers
+    matchDistance (float): max distance between tracked and true centers
+
+    Returns
+    -------
+    result (dict): accuracy metrics and frame times
+    """
+    trackBlobs = forcestamp.TrackBlobs()
+    trackMarkers = forcestamp.TrackMarkers(radii)
+
+    numFrames = 0
+    frameTimes = []
+    matched = 0
+    total = 0
+    fixed = 0
+    correct = 0
+    centerErrors = []
+    rotationErrors = []
+    firstSeen = {}
+    locked = {}
+
+    for i, (frame, truth) in enumerate(zip(frames, truths)):
+        t = time.perf_counter()
+        blobs = trackBlobs.update(frame)
+        trackMarkers.update(frame, blobs)
+        frameTimes.append(time.perf_counter() - t)
+        numFrames += 1
+
+        matches = matchMarkers(truth, trackMarkers.markers, matchDistance)
+        for index, (true, mkr) in enumerate(zip(truth, matches)):
+            # true markers are identified by their ID and order in the frame
+            key = (true.ID, index)
+            firstSeen.setdefault(key, i)
+            total += 1
+            if mkr is None:
+                continue
+            matched += 1
+            centerErrors.append(forcestamp.distance(true.pos, mkr.pos))
+            if not mkr.ID_fixed:
+                continue
+            fixed += 1
+            if mkr.ID != true.ID:
+                continue
+            correct += 1
+            if key not in locked:
+                locked[key] = i - firstSeen[key]
+            rot = getattr(true, 'rot', None)
+            if rot is not None:
+                rotationErrors.append(abs(circular.angleDifference(mkr.rot, rot)))
+
+    def stats(values, scale=1):
+        values = np.asarray(values, dtype=float) * scale
+        if len(values) == 0:
+            return {'mean': None, 'p95': None, 'max': None}
+        return {'mean': float(np.mean(values)),
+                'p95': float(np.percentile(values, 95)),
+                'max': float(np.max(values))}
+
+    toLock = list(locked.values())
+    return {
+        'frames': numFrames,
+        'trueMarkers': len(firstSeen),
+        'detectionRate': matched / total if total else None,
+        'idAccuracy': correct / fixed if fixed else None,
+        'lockRate': len(locked) / len(firstSeen) if firstSeen else None,
+        'framesToLock': stats(toLock),
+        'centerError': stats(centerErrors),
+        'rotationError': stats(rotationErrors, 180 / np.pi),
+        'frameTime_ms': stats(frameTimes, 1000),
+    }
+
+
+def scoreSynthetic(numMarkers, numFingers=0, noise=0.5, numFrames=100, seed=0, radius=20, **kwargs):
+    # score a random synthetic scene of moving and rotating markers
+    rng = np.random.RandomState(seed)
+    markers, fingers = synthetic.randomScene(numMarkers, numFingers, radius=radius, rng=rng)
+    sequence = list(synthetic.animate(markers, fingers, numFrames, noise=noise, rng=rng))
+    result = score([frame for frame, truth in sequence], [truth for frame, truth in sequence], **kwargs)
+    result.update({'markers': numMarkers, 'fingers': numFingers, 'noise': noise, 'seed': seed})
+    return result
+
+
+def loadTruth(path):
+    # true markers of each frame of a recording from a truth JSON file
+    with open(path) as f:
+        data = json.load(f)
+
+    def markers(items):
+        return [synthetic.SyntheticMarker(m['ID'], tuple(m['pos']), rot=m.get('rot')) for m in items]
+
+    if isinstance(data, dict):
+        return [markers(items) for items in data['frames']]
+    return itertools.repeat(markers(data))
+
+
+def scoreRecording(path, truthPath, **kwargs):
+    import recording
+    replay = recording.FrameReplay(path, realtime=False)
+    result = score(replay, loadTruth(truthPath), **kwargs)
+    result.update({'recording': path})
+    return result
+
+
+def compare(results, baseline, tolerance=0.1):
+    # metrics which got worse than the baseline
+    # rates may drop by tolerance, errors may grow by a fraction tolerance (plus 0.1 px or degree)
+    def sceneKey(r):
+        return (r.get('recording'), r.get('markers'), r.get('fingers'), r.get('noise'), r.get('seed'))
+
+    reference = dict((sceneKey(r), r) for r in baseline['results'])
+    regressions = []
+    for result in results:
+        base = reference.get(sceneKey(result))
+        if base is None:
+            continue
+        for name in ['detectionRate', 'idAccuracy', 'lockRate']:
+            if base[name] is not None and (result[name] is None or result[name] < base[name] - tolerance):
+                regressions.append((result, name, result[name], base[name]))
+        for name in ['centerError', 'rotationError']:
+            value = result[name]['p95']
+            limit = base[name]['p95']
+            if limit is not None and value is not None and value > limit * (1 + tolerance) + 0.1:
+                regressions.append((result, name, value, limit))
+    return regressions
+
+
+def report(results):
+    def fmt(value, pattern='%8.3f'):
+        return '%8s' % '-' if value is None else pattern % value
+
+    lines = ['%7s %7s %6s %8s %8s %8s %8s %8s %8s %8s' % (
+        'markers', 'fingers', 'noise', 'detect', 'ID', 'lock', 'toLock', 'center', 'rot deg', 'ms')]
+    for r in results:
+        lines.append('%7s %7s %6s %s %s %s %s %s %s %s' % (
+            r.get('markers', '-'), r.get('fingers', '-'), r.get('noise', '-'),
+            fmt(r['detectionRate']), fmt(r['idAccuracy']), fmt(r['lockRate']),
+            fmt(r['framesToLock']['mean'], '%8.1f'), fmt(r['centerError']['p95']),
+            fmt(r['rotationError']['p95']), fmt(r['frameTime_ms']['mean'])))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Score ForceStamp marker tracking against ground truth')
+    parser.add_argument('--markers', type=int, nargs='+', default=[1, 2, 3], help='marker counts')
+    parser.add_argument('--fingers', type=int, nargs='+', default=[0, 3], help='finger counts')
+    parser.add_argument('--noise', type=float, nargs='+', default=[0, 0.5], help='std of the frame noise')
+    parser.add_argument('--frames', type=int, default=100, help='frames per scene')
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0])
+    parser.add_argument('--recording', help='score a recording instead of synthetic scenes')
+    parser.add_argument('--truth', help='truth JSON file of the recording')
+    parser.add_argument('--output', help='write the results to a JSON file')
+    parser.add_argument('--compare', help='baseline JSON file to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    if args.recording:
+        if not args.truth:
+            parser.error('--recording needs --truth')
+        results = [scoreRecording(args.recording, args.truth)]
+    else:
+        results = [scoreSynthetic(m, f, noise, args.frames, seed)
+                   for m in args.markers for f in args.fingers
+                   for noise in args.noise for seed in args.seeds]
+    print(report(results))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'config': vars(args), 'results': results}, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for result, name, value, base in regressions:
+            print('regression: %s %s: %s (baseline %s)' % (
+                result.get('recording') or '%d markers, %d fingers, noise %g' % (
+                    result['markers'], result['fingers'], result['noise']),
+                name, value, base))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
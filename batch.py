@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+
+"""Batch reprocessing of recordings, with parameter sweeps
+
+    A recording is split into segments at runs of frames without contacts.
+    After MIN_GAP such frames, TrackBlobs has reset and TrackMarkers has
+    dropped every marker, so each segment can be tracked from a fresh
+    pipeline in its own process and still give the same markers as one pass
+    over the whole recording. Segments of every parameter set are processed
+    in a process pool, and the markers and blobs of every frame are written
+    column by column to one .npz file.
+
+    Output columns
+    --------------
+    marker_run, marker_frame, marker_timestamp, marker_<field>: one row per
+        tracked marker and frame, fields of output.MARKER_DTYPE
+    blob_run, blob_frame, blob_<field>: one row per blob and frame, fields of
+        output.BLOB_DTYPE
+    run_<parameter>: settings of each parameter set (run)
+    run_radii: marker radii of each run, padded with nan
+    segments, num_frames, recording
+
+    Usage
+    -----
+    python batch.py session.fsr --output session.npz
+    python batch.py session.fsr --output sweep.npz --area-threshold 800 1000 1200 --force-threshold 4 6 8
+    results = batch.load('sweep.npz')   # results['markers'][results['markers']['run'] == 0]
+"""
+
+from __future__ import print_function
+
+import argparse
+import itertools
+import multiprocessing
+import sys
+import time
+
+import numpy as np
+
+import output
+import pipeline
+import recording
+
+# frames without contacts after which the trackers hold no state:
+# a marker without blobs is dropped on its 20th frame
+MIN_GAP = 20
+
+# parameters swept by the CLI, with their pipeline.Pipeline argument names
+PARAMETERS = ['areaThreshold', 'forceThreshold', 'binThreshold', 'distanceTolerance']
+# defaults of pipeline.Pipeline
+DEFAULTS = {'areaThreshold': 1000, 'forceThreshold': 6, 'binThreshold': 2, 'distanceTolerance': 1}
+
+MARKER_COLUMNS = np.dtype([('run', '<i4'), ('frame', '<i8'), ('timestamp', '<f8')] + output.MARKER_DTYPE.descr)
+BLOB_COLUMNS = np.dtype([('run', '<i4'), ('frame', '<i8')] + output.BLOB_DTYPE.descr)
+
+
+def frameMaxima(path):
+    # max force of every frame of a recording, read chunk by chunk
+    maxima = [chunk['frame'].reshape(len(chunk), -1).max(axis=1) for chunk in recording.readChunks(path)]
+    if len(maxima) == 0:
+        return np.zeros(0)
+    return np.concatenate(maxima)
+
+
+def findSegments(maxima, forceThreshold=6, minGap=MIN_GAP):
+    """Split a recording into segments which can be tracked independently
+
+    Args
+    ----
+    maxima (array:float): max force of every frame
+    forceThreshold (float): smallest blob force threshold the segments are tracked with.
+        a frame has no contacts when no 3 x 3 blob can exceed it
+    minGap (int): frames without contacts before a split
+
+    Returns
+    -------
+    segments (list:tuple): (start, stop) frame indices, covering every frame
+    """
+    numFrames = len(maxima)
+    empty = np.asarray(maxima) * 9 <= forceThreshold
+
+    # start and end of each run of frames without contacts
+    edges = np.diff(np.concatenate([[0], empty.astype(np.int8), [0]]))
+    runStarts = np.flatnonzero(edges == 1)
+    runEnds = np.flatnonzero(edges == -1)
+
+    segments = []
+    start = 0
+    for runStart, runEnd in zip(runStarts, runEnds):
+        # split after minGap frames of the run, the rest starts the next segment
+        cut = runStart + minGap
+        if runEnd - runStart >= minGap and start < cut < numFrames:
+            segments.append((start, int(cut)))
+            start = int(cut)
+    if start < numFrames:
+        segments.append((start, numFrames))
+    return segments
+
+
+class FrameCollector:
+    # pipeline output keeping the marker and blob records of every frame
+    # run: run index of the records
+    # firstFrame: frame index of the first frame sent
+
+    def __init__(self, run=0, firstFrame=0):
+        self.run = run
+        self.frame = firstFrame
+        self.markers = []
+        self.blobs = []
+
+    def send(self, markers, blobs, timestamp):
+        records = output.markerRecords(markers)
+        rows = np.zeros(len(records), dtype=MARKER_COLUMNS)
+        rows['run'] = self.run
+        rows['frame'] = self.frame
+        rows['timestamp'] = timestamp
+        for name in output.MARKER_DTYPE.names:
+            rows[name] = records[name]
+        self.markers.append(rows)
+
+        records = output.blobRecords(blobs)
+        rows = np.zeros(len(records), dtype=BLOB_COLUMNS)
+        rows['run'] = self.run
+        rows['frame'] = self.frame
+        for name in output.BLOB_DTYPE.names:
+            rows[name] = records[name]
+        self.blobs.append(rows)
+
+        self.frame += 1
+
+    def records(self):
+        # (markers, blobs) structured arrays of every frame sent
+        return (np.concatenate(self.markers) if self.markers else np.zeros(0, dtype=MARKER_COLUMNS),
+                np.concatenate(self.blobs) if self.blobs else np.zeros(0, dtype=BLOB_COLUMNS))
+
+    def close(self):
+        pass
+
+
+def processSegment(task):
+    # track the frames of a segment from a fresh pipeline
+    runIndex, segment, path, start, stop, settings = task
+    source = recording.FrameReplay(path, realtime=False, start=start)
+    collector = FrameCollector(runIndex, start)
+    segmentPipeline = pipeline.Pipeline(source, [collector], **settings)
+    segmentPipeline.run(maxFrames=stop - start)
+    markers, blobs = collector.records()
+    return runIndex, segment, markers, blobs
+
+
+def run(path, settings, workers=None, minGap=MIN_GAP):
+    """Track a recording with one or more parameter sets
+
+    Args
+    ----
+    path (str): recording
+    settings (list:dict): keyword arguments of pipeline.Pipeline for each run
+    workers (int): processes of the pool, the number of cores if None, in this process if 0
+    minGap (int): frames without contacts before a split
+
+    Returns
+    -------
+    markers, blobs (array): records of every run, frame and marker or blob,
+        of MARKER_COLUMNS and BLOB_COLUMNS
+    segments (list:tuple): (start, stop) frame indices of the segments
+    numFrames (int): frames of the recording
+    """
+    maxima = frameMaxima(path)
+    forceThreshold = min(s.get('forceThreshold', DEFAULTS['forceThreshold']) for s in settings)
+    segments = findSegments(maxima, forceThreshold, minGap)
+
+    tasks = [(i, j, path, start, stop, s)
+             for i, s in enumerate(settings) for j, (start, stop) in enumerate(segments)]
+    # longest segments first, so the pool does not end waiting on one of them
+    tasks.sort(key=lambda task: task[4] - task[3], reverse=True)
+
+    if workers == 0:
+        results = [processSegment(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = list(pool.imap_unordered(processSegment, tasks))
+        finally:
+            pool.terminate()
+            pool.join()
+
+    # merge in run and frame order
+    results.sort(key=lambda result: result[:2])
+    markers = np.concatenate([result[2] for result in results] or [np.zeros(0, dtype=MARKER_COLUMNS)])
+    blobs = np.concatenate([result[3] for result in results] or [np.zeros(0, dtype=BLOB_COLUMNS)])
+    return markers, blobs, segments, len(maxima)
+
+
+def sweepSettings(values, radii=pipeline.RADII):
+    # one settings dict per combination of parameter values
+    # values: dict of parameter name to a list of values. 'radii' may list
+    #     several sets of marker radii, radii is used otherwise
+    values = dict(values)
+    values.setdefault('radii', [radii])
+    names = [name for name in PARAMETERS + ['radii'] if name in values]
+    settings = []
+    for combination in itertools.product(*[values[name] for name in names]):
+        s = dict(zip(names, combination))
+        s['radii'] = list(s['radii'])
+        settings.append(s)
+    return settings
+
+
+def save(path, markers, blobs, settings, segments, numFrames, recordingPath=''):
+    columns = {}
+    for name in MARKER_COLUMNS.names:
+        columns['marker_' + name] = markers[name]
+    for name in BLOB_COLUMNS.names:
+        columns['blob_' + name] = blobs[name]
+    for name in PARAMETERS:
+        columns['run_' + name] = np.array([s.get(name, DEFAULTS[name]) for s in settings], dtype=np.float)
+    radii = np.full((len(settings), max([len(s['radii']) for s in settings] or [0])), np.nan)
+    for row, s in zip(radii, settings):
+        row[:len(s['radii'])] = s['radii']
+    columns['run_radii'] = radii
+    columns['segments'] = np.array(segments, dtype=np.int64).reshape(-1, 2)
+    columns['num_frames'] = np.array(numFrames)
+    columns['recording'] = np.array(recordingPath)
+    np.savez_compressed(path, **columns)
+
+
+def load(path):
+    # results of a batch file: dict of 'markers' and 'blobs' structured arrays,
+    # 'runs' (parameter name to values per run) and the other columns
+    with np.load(path) as data:
+        columns = dict((name, data[name]) for name in data.files)
+    results = {}
+    for key, prefix, dtype in [('markers', 'marker_', MARKER_COLUMNS), ('blobs', 'blob_', BLOB_COLUMNS)]:
+        records = np.zeros(len(columns[prefix + dtype.names[0]]), dtype=dtype)
+        for name in dtype.names:
+            records[name] = columns.pop(prefix + name)
+        results[key] = records
+    results['runs'] = dict((name, columns.pop('run_' + name)) for name in PARAMETERS)
+    results['runs']['radii'] = [row[~np.isnan(row)] for row in columns.pop('run_radii')]
+    results.update(columns)
+    return results
+
+
+def report(markers, blobs, settings):
+    # marker and blob rows and the marker IDs found by each run
+    lines = ['%4s %s %12s %10s %s' % ('run', ' '.join('%17s' % name for name in PARAMETERS),
+                                      'marker rows', 'blob rows', 'IDs')]
+    for i, s in enumerate(settings):
+        rows = markers[markers['run'] == i]
+        IDs = sorted(set(rows['ID'][rows['ID'] > 0].tolist()))
+        lines.append('%4d %s %12d %10d %s' % (i, ' '.join('%17g' % s.get(name, DEFAULTS[name]) for name in PARAMETERS),
+                                              len(rows), np.count_nonzero(blobs['run'] == i),
+                                              ' '.join(str(ID) for ID in IDs)))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Track ForceStamp recordings in parallel, '
+                                                 'optionally over a grid of detection parameters')
+    parser.add_argument('recording')
+    parser.add_argument('--output', help='write the markers and blobs of every frame to this .npz file')
+    parser.add_argument('--workers', type=int, default=None, help='processes (default: number of cores)')
+    parser.add_argument('--min-gap', type=int, default=MIN_GAP,
+                        help='frames without contacts before a split, at least %d' % MIN_GAP)
+    parser.add_argument('--radii', type=float, nargs='+', default=pipeline.RADII, help='marker radii')
+    parser.add_argument('--area-threshold', type=float, nargs='+', default=[1000])
+    parser.add_argument('--force-threshold', type=float, nargs='+', default=[6])
+    parser.add_argument('--bin-threshold', type=float, nargs='+', default=[2])
+    parser.add_argument('--distance-tolerance', type=float, nargs='+', default=[1])
+    args = parser.parse_args(argv)
+
+    if args.min_gap < MIN_GAP:
+        parser.error('--min-gap must be at least %d' % MIN_GAP)
+
+    settings = sweepSettings({'areaThreshold': args.area_threshold,
+                              'forceThreshold': args.force_threshold,
+                              'binThreshold': args.bin_threshold,
+                              'distanceTolerance': args.distance_tolerance}, args.radii)
+
+    t_start = time.time()
+    markers, blobs, segments, numFrames = run(args.recording, settings, args.workers, args.min_gap)
+    duration = time.time() - t_start
+    print('%d frames in %d segments, %d runs in %.1f s (%.1f frames/s)' % (
+        numFrames, len(segments), len(settings), duration,
+        numFrames * len(settings) / duration if duration > 0 else 0))
+    print(report(markers, blobs, settings))
+
+    if args.output:
+        save(args.output, markers, blobs, settings, segments, numFrames, args.recording)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark of the detection pipeline on synthetic frames
+
+    Times detectBlobs, TrackBlobs.update, findMarker, TrackMarkers.update and
+    marker ID recognition (extractCode + recognizeID) for every combination
+    of marker and finger counts, and writes the results as JSON.
+
+    Usage
+    -----
+    python benchmark.py --markers 1 2 4 --fingers 0 5 --output bench.json
+    python benchmark.py --compare bench.json --tolerance 0.25
+    python benchmark.py --memory
+
+    With --compare, the run fails (exit status 1) when the median time of a
+    stage is slower than the baseline by more than the tolerance.
+
+    With --memory, the memory allocated per frame by detectBlobs is measured
+    with tracemalloc instead of timing the stages: the transient peak and the
+    memory retained after the frame, with the scratch images of TrackBlobs
+    and with fresh images every frame.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+import numpy as np
+
+import forcestamp
+import synthetic
+
+STAGES = ['detectBlobs', 'TrackBlobs.update', 'findMarker', 'TrackMarkers.update', 'recognizeID']
+
+# marker radii of the GUI
+RADII = [55 / 2 / 1.25, 17 / 1.25, 20.0, 16 / 1.25]
+
+
+def statistics(durations):
+    # statistics of durations in seconds, in milliseconds
+    values = np.asarray(durations) * 1000
+    if len(values) == 0:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'mean_ms': float(np.mean(values)),
+        'p50_ms': float(np.percentile(values, 50)),
+        'p95_ms': float(np.percentile(values, 95)),
+        'max_ms': float(np.max(values)),
+    }
+
+
+def benchmarkScene(frames, radii=RADII, warmup=10):
+    # durations of each stage over a sequence of frames
+    durations = dict((stage, []) for stage in STAGES)
+    clock = time.perf_counter
+
+    trackBlobs = forcestamp.TrackBlobs()
+    trackMarkers = forcestamp.TrackMarkers(radii)
+    for i, frame in enumerate(frames):
+        record = i >= warmup
+
+        t = clock()
+        forcestamp.detectBlobs(frame, areaThreshold=1000)
+        t_detect = clock() - t
+
+        t = clock()
+        blobs = trackBlobs.update(frame)
+        t_trackBlobs = clock() - t
+
+        t = clock()
+        markers = []
+        if len(blobs) > 3:
+            markers, unused = forcestamp.findMarker(blobs, markerRadii=radii, distanceTolerance=1)
+        t_find = clock() - t
+
+        t = clock()
+        trackMarkers.update(frame, blobs)
+        t_trackMarkers = clock() - t
+
+        # ID recognition of the markers found in this frame
+        t_recognize = 0
+        for mkr in markers:
+            mkr.update(blobs, frame)
+            t = clock()
+            mkr.code, mkr.phaseError = mkr.extractCode()
+            mkr.recognizeID()
+            t_recognize += clock() - t
+
+        if record:
+            durations['detectBlobs'].append(t_detect)
+            durations['TrackBlobs.update'].append(t_trackBlobs)
+            durations['findMarker'].append(t_find)
+            durations['TrackMarkers.update'].append(t_trackMarkers)
+            if len(markers) > 0:
+                durations['recognizeID'].append(t_recognize)
+
+    return durations
+
+
+def memoryProfile(frames, warmup=10):
+    # memory allocated by detectBlobs per frame, in bytes:
+    # transient peak during the frame and memory still held after it
+    import tracemalloc
+
+    buffers = forcestamp.BlobBuffers(frames[0].shape, frames[0].dtype)
+    profile = {}
+    for name, frameBuffers in [('buffered', buffers), ('unbuffered', None)]:
+        peaks = []
+        retained = []
+        tracemalloc.start()
+        try:
+            for i, frame in enumerate(frames):
+                before = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+                result = forcestamp.detectBlobs(frame, areaThreshold=1000, buffers=frameBuffers)
+                peak = tracemalloc.get_traced_memory()[1]
+                del result
+                if i >= warmup:
+                    peaks.append(peak - before)
+                    retained.append(tracemalloc.get_traced_memory()[0] - before)
+        finally:
+            tracemalloc.stop()
+        profile[name] = {
+            'peak_p50_bytes': float(np.percentile(peaks, 50)),
+            'peak_max_bytes': float(np.max(peaks)),
+            'retained_p50_bytes': float(np.percentile(retained, 50)),
+        }
+    profile['frame_bytes'] = frames[0].nbytes
+    return profile
+
+
+def sceneFrames(numMarkers, numFingers, numFrames, seed=0, radius=20, noise=0.5):
+    # frames of a random synthetic scene
+    rng = np.random.RandomState(seed)
+    markers, fingers = synthetic.randomScene(numMarkers, numFingers, radius=radius, rng=rng)
+    frames = [frame for frame, truth in synthetic.animate(markers, fingers, numFrames, noise=noise, rng=rng)]
+    return markers, fingers, frames
+
+
+def runMemory(markerCounts=(0, 1, 2, 4), fingerCounts=(0, 2, 5), numFrames=200, seed=0,
+              radius=20, noise=0.5, warmup=10):
+    # memory profile of every combination of marker and finger counts
+    results = []
+    for numMarkers in markerCounts:
+        for numFingers in fingerCounts:
+            markers, fingers, frames = sceneFrames(numMarkers, numFingers, numFrames + warmup,
+                                                   seed, radius, noise)
+            result = {'markers': len(markers), 'fingers': len(fingers)}
+            result.update(memoryProfile(frames, warmup=warmup))
+            results.append(result)
+    return results
+
+
+def reportMemory(results):
+    lines = ['%7s %7s %9s %12s %12s %12s %12s' % (
+        'markers', 'fingers', 'frame KB', 'peak KB', 'max KB', 'retained B', 'unbuf. KB')]
+    for r in results:
+        lines.append('%7d %7d %9.1f %12.1f %12.1f %12.0f %12.1f' % (
+            r['markers'], r['fingers'], r['frame_bytes'] / 1024.,
+            r['buffered']['peak_p50_bytes'] / 1024., r['buffered']['peak_max_bytes'] / 1024.,
+            r['buffered']['retained_p50_bytes'], r['unbuffered']['peak_p50_bytes'] / 1024.))
+    return '\n'.join(lines)
+
+
+def run(markerCounts=(0, 1, 2, 4), fingerCounts=(0, 2, 5), numFrames=200, seed=0,
+        radius=20, noise=0.5, warmup=10):
+    # benchmark every combination of marker and finger counts
+    results = []
+    for numMarkers in markerCounts:
+        for numFingers in fingerCounts:
+            markers, fingers, frames = sceneFrames(numMarkers, numFingers, numFrames + warmup,
+                                                   seed, radius, noise)
+            durations = benchmarkScene(frames, warmup=warmup)
+            for stage in STAGES:
+                result = {'markers': len(markers), 'fingers': len(fingers), 'stage': stage}
+                result.update(statistics(durations[stage]))
+                results.append(result)
+    return results
+
+
+def environment():
+    import cv2
+    import scipy
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'scipy': scipy.__version__,
+        'opencv': cv2.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'system': platform.system(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def compare(results, baseline, tolerance=0.25):
+    # stages whose median time regressed beyond the tolerance (fraction of the baseline)
+    reference = dict(((r['markers'], r['fingers'], r['stage']), r) for r in baseline['results'])
+    regressions = []
+    for result in results:
+        base = reference.get((result['markers'], result['fingers'], result['stage']))
+        if base is None or result['count'] == 0 or base['count'] == 0:
+            continue
+        if result['p50_ms'] > base['p50_ms'] * (1 + tolerance):
+            regressions.append((result, base))
+    return regressions
+
+
+def report(results):
+    lines = ['%7s %7s %-20s %6s %9s %9s %9s' % ('markers', 'fingers', 'stage', 'count', 'mean ms', 'p50 ms', 'p95 ms')]
+    for r in results:
+        if r['count'] == 0:
+            continue
+        lines.append('%7d %7d %-20s %6d %9.3f %9.3f %9.3f' % (
+            r['markers'], r['fingers'], r['stage'], r['count'], r['mean_ms'], r['p50_ms'], r['p95_ms']))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the ForceStamp detection pipeline on synthetic frames')
+    parser.add_argument('--markers', type=int, nargs='+', default=[0, 1, 2, 4], help='marker counts')
+    parser.add_argument('--fingers', type=int, nargs='+', default=[0, 2, 5], help='finger counts')
+    parser.add_argument('--frames', type=int, default=200, help='timed frames per scene')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--noise', type=float, default=0.5, help='std of the frame noise')
+    parser.add_argument('--output', help='write the results to a JSON file')
+    parser.add_argument('--compare', help='baseline JSON file to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown against the baseline')
+    parser.add_argument('--memory', action='store_true', help='profile the memory allocated per frame by detectBlobs')
+    args = parser.parse_args(argv)
+
+    if args.memory:
+        results = runMemory(args.markers, args.fingers, args.frames, args.seed, noise=args.noise)
+        print(reportMemory(results))
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump({'environment': environment(), 'results': results}, f, indent=2)
+        return 0
+
+    results = run(args.markers, args.fingers, args.frames, args.seed, noise=args.noise)
+    print(report(results))
+
+    output = {
+        'environment': environment(),
+        'config': {'markers': args.markers, 'fingers': args.fingers, 'frames': args.frames,
+                   'seed': args.seed, 'noise': args.noise, 'radii': RADII},
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for result, base in regressions:
+            print('regression: %d markers, %d fingers, %s: %.3f ms (baseline %.3f ms)' % (
+                result['markers'], result['fingers'], result['stage'], result['p50_ms'], base['p50_ms']))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,84 @@
+"""Circular statistics over arrays of phases
+
+    Used by the marker rotation estimator. All angles are in radians and
+    every function accepts scalars or NumPy arrays.
+"""
+
+import numpy as np
+
+
+def wrapAngle(angle):
+    # wrap angles to [0, 2pi)
+    return np.mod(angle, 2 * np.pi)
+
+
+def angleDifference(a, b):
+    # signed difference a - b wrapped to [-pi, pi)
+    return np.mod(np.asarray(a) - b + np.pi, 2 * np.pi) - np.pi
+
+
+def circularMean(angles, weights=None):
+    """Mean direction and mean resultant length of a set of angles
+
+    Args
+    ----
+    angles (array:float): angles in radians
+    weights (array:float): optional non-negative weight of each angle
+
+    Returns
+    -------
+    mean (float): mean direction wrapped to [0, 2pi), nan for empty input
+    resultant (float): mean resultant length (0-1). 1 when all angles agree,
+        close to 0 when they are spread around the circle
+    """
+    angles = np.asarray(angles, dtype=float)
+    if angles.size == 0:
+        return np.nan, 0.0
+
+    if weights is None:
+        C = np.mean(np.cos(angles))
+        S = np.mean(np.sin(angles))
+    else:
+        weights = np.asarray(weights, dtype=float)
+        total = np.sum(weights)
+        if total <= 0:
+            return np.nan, 0.0
+        C = np.dot(weights, np.cos(angles)) / total
+        S = np.dot(weights, np.sin(angles)) / total
+
+    resultant = np.hypot(C, S)
+    if resultant == 0:
+        return np.nan, 0.0
+
+    return wrapAngle(np.arctan2(S, C)), resultant
+
+
+def slotOffsets(phases, slots, n=15):
+    # rotation implied by each blob: its phase minus the nominal phase of its slot
+    return wrapAngle(np.asarray(phases) - np.asarray(slots) * 2 * np.pi / n)
+
+
+def nearestSlots(phases, rot, n=15):
+    # slot index closest to each phase for a marker rotated by rot.
+    # phases which cannot be assigned (nan) get slot -1
+    slots = np.round((np.asarray(phases, dtype=float) - rot) / (2 * np.pi / n))
+    valid = np.isfinite(slots)
+    out = np.full(slots.shape, -1, dtype=int)
+    out[valid] = np.mod(slots[valid], n).astype(int)
+    return out
+
+
+def unwrapAngle(prevUnwrapped, angle):
+    # accumulate a wrapped angle onto an unwrapped (multi-turn) angle
+    # assuming it moved less than half a turn since the previous sample
+    return prevUnwrapped + angleDifference(angle, prevUnwrapped)
+
+
+def unwrapAngles(angles, start=0.0):
+    # cumulative rotation over a sequence of wrapped angles
+    angles = np.asarray(angles, dtype=float)
+    if angles.size == 0:
+        return angles
+    steps = angleDifference(np.diff(angles), 0)
+    first = unwrapAngle(start, angles[0])
+    return first + np.concatenate(([0.0], np.cumsum(steps)))
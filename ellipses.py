@@ -87,28 +87,7 @@ class LSqEllipse:
         """
 
         #eigenvectors are the coefficients of an ellipse in general form
-        #a*x^2 + 2*b*x*y + c*y^2 + 2*d*x + 2*f*y + g = 0 [eqn. 15) from (**) or (***)
-        a = self.coef[0,0]
-        b = self.coef[1,0]/2.
-        c = self.coef[2,0]
-        d = self.coef[3,0]/2.
-        f = self.coef[4,0]/2.
-        g = self.coef[5,0]
-        
-        #finding center of ellipse [eqn.19 and 20] from (**)
-        x0 = (c*d-b*f)/(b**2.-a*c)
-        y0 = (a*f-b*d)/(b**2.-a*c)
-        
-        #Find the semi-axes lengths [eqn. 21 and 22] from (**)
-        numerator = 2*(a*f*f+c*d*d+g*b*b-2*b*d*f-a*c*g)
-        denominator1 = (b*b-a*c)*( (c-a)*numpy.sqrt(1+4*b*b/((a-c)*(a-c)))-(c+a))
-        denominator2 = (b*b-a*c)*( (a-c)*numpy.sqrt(1+4*b*b/((a-c)*(a-c)))-(c+a))
-        width = numpy.sqrt(numerator/denominator1)
-        height = numpy.sqrt(numerator/denominator2)
-
-        # angle of counterclockwise rotation of major-axis of ellipse to x-axis [eqn. 23] from (**)
-        # or [eqn. 26] from (***).
-        phi = .5*numpy.arctan((2.*b)/(a-c))
+        x0, y0, width, height, phi = _ellipse_parameters(self.coef[:, 0].A.ravel())
 
         self._center = [x0, y0]
         self._width = width
@@ -138,6 +117,119 @@ class LSqEllipse:
         return self.center, self.width, self.height, self.phi
 
 
+def _ellipse_parameters(coef):
+    """finds the important parameters of ellipses from their coefficients
+
+    Theory taken form http://mathworld.wolfram
+    Args
+    -----
+    coef (array): coefficients [a,b,c,d,f,g] along the first axis, corresponding
+        to ax**2+2bxy+cy**2+2dx+2fy+g. Any trailing axes are treated as a batch
+    Returns
+    _______
+    x0, y0 (array): center
+    width (array): major axis
+    height (array): minor axis
+    phi (array): rotation of major axis form the x-axis in radians
+    """
+    #a*x^2 + 2*b*x*y + c*y^2 + 2*d*x + 2*f*y + g = 0 [eqn. 15) from (**) or (***)
+    a = coef[0]
+    b = coef[1]/2.
+    c = coef[2]
+    d = coef[3]/2.
+    f = coef[4]/2.
+    g = coef[5]
+
+    #finding center of ellipse [eqn.19 and 20] from (**)
+    x0 = (c*d-b*f)/(b**2.-a*c)
+    y0 = (a*f-b*d)/(b**2.-a*c)
+
+    #Find the semi-axes lengths [eqn. 21 and 22] from (**)
+    numerator = 2*(a*f*f+c*d*d+g*b*b-2*b*d*f-a*c*g)
+    denominator1 = (b*b-a*c)*( (c-a)*numpy.sqrt(1+4*b*b/((a-c)*(a-c)))-(c+a))
+    denominator2 = (b*b-a*c)*( (a-c)*numpy.sqrt(1+4*b*b/((a-c)*(a-c)))-(c+a))
+    width = numpy.sqrt(numerator/denominator1)
+    height = numpy.sqrt(numerator/denominator2)
+
+    # angle of counterclockwise rotation of major-axis of ellipse to x-axis [eqn. 23] from (**)
+    # or [eqn. 26] from (***).
+    phi = .5*numpy.arctan((2.*b)/(a-c))
+
+    return x0, y0, width, height, phi
+
+
+def fit_ellipses(x, y, offsets):
+    """Batched least squares fitting of several ellipses at once
+
+    Same algorithm as LSqEllipse.fit (*), with the scatter matrices of all
+    point sets built and solved with stacked numpy.linalg calls.
+    Args
+    ----
+    x, y (array:float): coordinates of all point sets concatenated
+    offsets (array:int): start index of each point set in x and y, with
+        len(x) appended, e.g. [0, 12, 20, 31] for three sets
+    Returns
+    -------
+    center (array): (N, 2) centers [x0, y0]
+    width (array): (N,) major axes
+    height (array): (N,) minor axes
+    phi (array): (N,) rotation of major axes from the x-axis in radians
+    Sets with less than 5 points or without an elliptic solution are nan.
+    """
+    x = numpy.asarray(x, dtype=float)
+    y = numpy.asarray(y, dtype=float)
+    counts = numpy.diff(offsets)
+    num = len(counts)
+    labels = numpy.repeat(numpy.arange(num), counts)
+
+    #Quadratic and linear parts of design matrices [eqn. 15 and 16] from (*)
+    D1 = numpy.stack([x**2, x*y, y**2], axis=1)
+    D2 = numpy.stack([x, y, numpy.ones(len(x))], axis=1)
+
+    #forming scatter matrices [eqn. 17] from (*), summed per point set
+    S1 = numpy.zeros((num, 3, 3))
+    S2 = numpy.zeros((num, 3, 3))
+    S3 = numpy.zeros((num, 3, 3))
+    numpy.add.at(S1, labels, D1[:, :, None]*D1[:, None, :])
+    numpy.add.at(S2, labels, D1[:, :, None]*D2[:, None, :])
+    numpy.add.at(S3, labels, D2[:, :, None]*D2[:, None, :])
+
+    #singular systems are solved against identity and discarded afterwards
+    valid = (counts >= 5) & (numpy.abs(numpy.linalg.det(S3)) > 1e-12)
+    S3[~valid] = numpy.eye(3)
+
+    #|d f g> = -S3^(-1)*S2^(T)*|a b c> [eqn. 24]
+    T = -numpy.linalg.solve(S3, S2.transpose(0, 2, 1))
+
+    #Inverse of the constraint matrix [eqn. 18]
+    C1inv = numpy.array([[0., 0., .5], [0., -1., 0.], [.5, 0., 0.]])
+
+    #Reduced scatter matrix [eqn. 29]
+    M = numpy.matmul(C1inv, S1 + numpy.matmul(S2, T))
+
+    #M*|a b c >=l|a b c >. Find eigenvalues and eigenvectors from this equation [eqn. 28]
+    evec = numpy.linalg.eig(M)[1].real
+
+    # eigenvector must meet constraint 4ac - b^2 to be valid.
+    cond = 4*evec[:, 0, :]*evec[:, 2, :] - evec[:, 1, :]**2
+    valid &= numpy.any(cond > 0, axis=1)
+    a1 = evec[numpy.arange(num), :, numpy.argmax(cond > 0, axis=1)]
+    a2 = numpy.matmul(T, a1[:, :, None])[:, :, 0]
+
+    # eigenvectors |a b c d f g>
+    coef = numpy.concatenate([a1, a2], axis=1).T
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        x0, y0, width, height, phi = _ellipse_parameters(coef)
+
+    center = numpy.stack([x0, y0], axis=1)
+    center[~valid] = numpy.nan
+    width[~valid] = numpy.nan
+    height[~valid] = numpy.nan
+    phi[~valid] = numpy.nan
+
+    return center, width, height, phi
+
+
 def make_test_ellipse(center=[1,1], width=1, height=.6, phi=3.14/5):
     """Generate Elliptical data with noise
     
@@ -2,27 +2,32 @@ import numpy as np
 from scipy.ndimage.filters import maximum_filter, minimum_filter
 import itertools
 import bch
-import ellipses
+import circular
+import timing
 import forcestamp_c
 import time
 import cv2
 from scipy.spatial import distance as dist
-import copy
 
 
-def findLocalPeaks(img, threshold=0.5, kernal=3):
+def findLocalPeaks(img, threshold=0.5, kernal=3, buffers=None):
+    # buffers: BlobBuffers of the image shape to work in without allocating.
+    # the returned peak image is then buffers.peaks, overwritten by the next call
+    if buffers is None:
+        buffers = BlobBuffers(img.shape, img.dtype)
+
     # apply the local maximum filter; all pixel of maximum value
     # in their neighborhood are set to 1
-    local_max_g = maximum_filter(img, kernal)
-    local_min_g = minimum_filter(img, kernal)
+    local_max_g = maximum_filter(img, kernal, output=buffers.localMax)
+    local_min_g = minimum_filter(img, kernal, output=buffers.localMin)
 
     # store local maxima
-    local_max = (local_max_g == img)
+    local_max = np.equal(local_max_g, img, out=buffers.peaks)
 
     # difference between local maxima and minima
-    diff = ((local_max_g - local_min_g) > threshold)
+    diff = np.subtract(local_max_g, local_min_g, out=buffers.localMax)
     # insert 0 where maxima do not exceed threshold
-    local_max[diff == 0] = 0
+    np.logical_and(local_max, np.greater(diff, threshold, out=buffers.above), out=local_max)
 
     return local_max
 
@@ -72,9 +77,73 @@ def distance(pt1, pt2):
     return np.sqrt((pt1[0] - pt2[0]) ** 2 + (pt1[1] - pt2[1]) ** 2)
 
 
+def fitCircles(points, offsets, radius=None, centers=None, iterations=5):
+    # algebraic circle fit (Kasa) of several point sets at once.
+    # points: (N, 2) coordinates of all sets concatenated
+    # offsets: start index of each set in points, with len(points) appended
+    # radius: known radius (scalar or per set). when given, the centers are
+    #   refined by fixed point iterations of the geometric fit with that radius
+    # centers: initial centers for the fixed radius fit (default: Kasa centers)
+    # returns (M, 2) centers and (M,) radii. nan for sets which cannot be fitted
+    points = np.asarray(points, dtype=np.float).reshape(-1, 2)
+    counts = np.diff(offsets)
+    num = len(counts)
+    labels = np.repeat(np.arange(num), counts)
+
+    def groupSum(values):
+        return np.bincount(labels, weights=values, minlength=num)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # centered coordinates of each set
+        x = points[:, 0]
+        y = points[:, 1]
+        mx = groupSum(x) / counts
+        my = groupSum(y) / counts
+        u = x - mx[labels]
+        v = y - my[labels]
+
+        # solve the 2x2 normal equations in closed form
+        Suu = groupSum(u * u)
+        Svv = groupSum(v * v)
+        Suv = groupSum(u * v)
+        Su3 = groupSum(u * u * u) + groupSum(u * v * v)
+        Sv3 = groupSum(v * v * v) + groupSum(v * u * u)
+        det = 2 * (Suu * Svv - Suv * Suv)
+        uc = (Svv * Su3 - Suv * Sv3) / det
+        vc = (Suu * Sv3 - Suv * Su3) / det
+
+        fitted = np.stack((mx + uc, my + vc), axis=1)
+        radii = np.sqrt(uc * uc + vc * vc + (Suu + Svv) / counts)
+        fitted[counts < 3] = np.nan
+        radii[counts < 3] = np.nan
+
+        if radius is not None:
+            radii = np.broadcast_to(np.asarray(radius, dtype=np.float), (num,))
+            if centers is not None:
+                fitted = np.array(centers, dtype=np.float).reshape(num, 2)
+            for i in range(iterations):
+                # move each center to the mean of the points projected back by radius
+                dx = x - fitted[labels, 0]
+                dy = y - fitted[labels, 1]
+                scale = radii[labels] / np.sqrt(dx * dx + dy * dy)
+                fitted[:, 0] = groupSum(x - dx * scale) / counts
+                fitted[:, 1] = groupSum(y - dy * scale) / counts
+
+    return fitted, radii
+
+
+def fitCircle(points, radius=None, center=None, iterations=5):
+    # fit a circle to a single point set. see fitCircles
+    points = np.asarray(points, dtype=np.float).reshape(-1, 2)
+    centers = None if center is None else [center]
+    fitted, radii = fitCircles(points, [0, len(points)], radius=radius,
+                               centers=centers, iterations=iterations)
+    return fitted[0], radii[0]
+
+
 def findPeakCoord(img):
     # return peak coordinates from input peak image
-    peaks = [tuple(coords) for coords in zip(*np.where(img == True))]
+    peaks = [tuple(coords) for coords in zip(*np.nonzero(img))]
     # print(peaks)
     return peaks
 
@@ -194,56 +263,169 @@ def findMarker(peaks, markerRadius=20, distanceTolerance=1, cMode=True):
 '''
 
 
+def fitRing(points, radius, tolerance, numHypotheses=32):
+    # robust fit of a circle with known radius (RANSAC).
+    # every hypothesis is one of the two circles through a pair of points,
+    # and all hypotheses are scored against all points in one array operation.
+    # returns the refined center and the inlier mask of points
+    points = np.asarray(points, dtype=np.float).reshape(-1, 2)
+    inliers = np.zeros(len(points), dtype=bool)
+    if len(points) < 2:
+        return np.array([np.nan, np.nan]), inliers
+
+    # pick a fixed number of pairs, evenly spread over all combinations
+    first, second = np.triu_indices(len(points), 1)
+    if len(first) > numHypotheses:
+        picked = np.linspace(0, len(first) - 1, numHypotheses).astype(np.int)
+        first = first[picked]
+        second = second[picked]
+
+    # circle centers through each pair, as in findCircles
+    p1 = points[first]
+    p2 = points[second]
+    q = np.sqrt(np.sum((p2 - p1) ** 2, axis=1))
+    valid = (q > 0) & (q < radius * 2.0)
+    if not np.any(valid):
+        return np.array([np.nan, np.nan]), inliers
+    p1 = p1[valid]
+    p2 = p2[valid]
+    q = q[valid]
+    middle = (p1 + p2) / 2
+    a = np.sqrt(radius ** 2 - (q / 2) ** 2)
+    normal = np.stack((p1[:, 1] - p2[:, 1], p2[:, 0] - p1[:, 0]), axis=1) / q[:, None]
+    centers = np.concatenate((middle + a[:, None] * normal,
+                              middle - a[:, None] * normal))
+
+    # score hypotheses by inlier count, ties broken by the inlier residuals
+    residuals = np.abs(np.sqrt(np.sum((points[None, :, :] - centers[:, None, :]) ** 2, axis=2)) - radius)
+    isInlier = residuals < tolerance
+    counts = np.sum(isInlier, axis=1)
+    residualSums = np.sum(np.where(isInlier, residuals, 0), axis=1)
+    best = np.lexsort((residualSums, -counts))[0]
+
+    # refine with all inliers of the best hypothesis
+    inliers = isInlier[best]
+    center, _ = fitCircle(points[inliers], radius=radius, center=centers[best])
+    if not np.all(np.isfinite(center)):
+        center = centers[best]
+    inliers = np.abs(np.sqrt(np.sum((points - center) ** 2, axis=1)) - radius) < tolerance
+
+    return center, inliers
+
+
+def fitMarkerRing(coords, center, radius, distanceTolerance, available=None):
+    # robust ring fit around a candidate center.
+    # available: mask of blobs which are not assigned to other markers yet
+    # returns the refined center and the member mask, or (None, None) when rejected
+    if available is None:
+        available = np.ones(len(coords), dtype=bool)
+
+    # robust fit over blobs around the ring, to leave out stray touches
+    dists = np.sqrt(np.sum((coords - center) ** 2, axis=1))
+    nearRing = np.where((np.abs(dists - radius) < distanceTolerance * 3) & available)[0]
+    center, inliers = fitRing(coords[nearRing], radius, distanceTolerance)
+    if np.sum(inliers) < 7:
+        return None, None
+    members = np.zeros(len(coords), dtype=bool)
+    members[nearRing[inliers]] = True
+
+    # touches inside the ring are tolerated up to half the pins
+    dists = np.sqrt(np.sum((coords - center) ** 2, axis=1))
+    innerBlobCount = np.sum((dists < radius - distanceTolerance) & ~members)
+    if innerBlobCount > max(2, np.sum(members) // 2):
+        return None, None
+
+    return center, members
+
+
+def scoreMarkerCenters(coords, markerRadii, distanceTolerance, rows=185, cols=105, chunk=4096):
+    # candidate marker centers from every pair of blobs and every radius.
+    # returns centers (C, 2), their radii (C,) and the number of blobs on each ring (C,)
+    first, second = np.triu_indices(len(coords), 1)
+    p1 = coords[first]
+    p2 = coords[second]
+    q = np.sqrt(np.sum((p2 - p1) ** 2, axis=1))
+
+    centers = []
+    radii = []
+    for radius in markerRadii:
+        # circle centers through each close enough pair, as in findCircles
+        valid = (q > 0) & (q < radius * 2.0)
+        middle = (p1[valid] + p2[valid]) / 2
+        a = np.sqrt(radius ** 2 - (q[valid] / 2) ** 2)
+        normal = np.stack((p1[valid, 1] - p2[valid, 1], p2[valid, 0] - p1[valid, 0]), axis=1) / q[valid, None]
+        cnts = np.concatenate((middle + a[:, None] * normal, middle - a[:, None] * normal))
+        # same check as isDotIncluded
+        inside = (cnts[:, 0] > 0) & (cnts[:, 0] < rows) & (cnts[:, 1] > 0) & (cnts[:, 1] < cols)
+        centers.append(cnts[inside])
+        radii.append(np.full(np.sum(inside), radius, dtype=np.float))
+    centers = np.concatenate(centers).reshape(-1, 2)
+    radii = np.concatenate(radii)
+
+    # count blobs on each candidate ring, in chunks to bound the distance matrix
+    scores = np.zeros(len(centers), dtype=np.int)
+    for start in range(0, len(centers), chunk):
+        dists = np.sqrt(np.sum((coords[None, :, :] - centers[start:start + chunk, None, :]) ** 2, axis=2))
+        onRing = np.abs(dists - radii[start:start + chunk, None]) < distanceTolerance
+        scores[start:start + chunk] = np.sum(onRing, axis=1)
+
+    return centers, radii, scores
+
+
 def findMarkerCenter(blobs, markerRadii, distanceTolerance):
-    for blobs_two in itertools.combinations(blobs, 2):
-        dist = distance(blobs_two[0].c, blobs_two[1].c)
-        # print(dist)
-        for radius in markerRadii:
-            if dist < radius * 2.0:
-                center1, center2 = findCircles((blobs_two[0].c, blobs_two[1].c), radius)
-                centers = [center1, center2]
-                # print('centers:', centers)
-                for cnt in centers:
-                    if isDotIncluded(cnt):
-                        temp_marker = marker(radius)
-                        innerBlobCount = 0
-                        # print('counting blobs')
-                        for b in blobs:
-                            dist = distance(center1, b.c)
-                            # print(dist)
-                            if dist < radius + distanceTolerance and \
-                               dist > radius - distanceTolerance:
-                                temp_marker.addBlob(b)
-                            elif dist < radius - distanceTolerance:
-                                innerBlobCount += 1
-                        # print(len(temp_marker.blobs))
-                        if len(temp_marker.blobs) > 6 and innerBlobCount < 3:
-                            blobs_unused = [blob for blob in blobs if blob not in temp_marker.blobs]
-                            # print(blobs_unused)
-                            temp_marker.pos = tuple(cnt)
-                            return temp_marker, blobs_unused
-
-    return None, blobs
-
-
-def findMarker(blobs, markerRadii=[20], distanceTolerance=1):
+    # find the best scored marker in blobs
+    markers, blobs_unused = findMarker(blobs, markerRadii, distanceTolerance, maxMarkers=1)
+    if len(markers) == 0:
+        return None, blobs
+    return markers[0], blobs_unused
+
+
+def findMarker(blobs, markerRadii=[20], distanceTolerance=1, maxMarkers=None):
     # distanceTolerance: tolerance when finding marker center candidates
 
     # for combination of two blobs, find circle center
     # for the circle center, calculate distance from any other blobs
-    # if there are at least 7 blobs with matching distance, confirm it as a center
+    # if there are at least 7 blobs with matching distance, confirm it as a center.
+    # candidates are scored once and suppressed within the radius of accepted markers
 
     markers = []
+    if len(blobs) < 2:
+        return markers, blobs
+
+    coords = np.array([b.c for b in blobs], dtype=np.float).reshape(-1, 2)
+    centers, radii, scores = scoreMarkerCenters(coords, markerRadii, distanceTolerance)
 
-    while len(blobs) > 1:  # while there are more than 2 blobs
-        marker, blobs = findMarkerCenter(blobs, markerRadii, distanceTolerance)
-        # print(marker, blobs)
-        if marker is None:
+    # best candidates first
+    candidates = np.where(scores >= 7)[0]
+    candidates = candidates[np.argsort(-scores[candidates], kind='mergesort')]
+
+    assigned = np.zeros(len(blobs), dtype=bool)
+    accepted = np.zeros((0, 2))
+    for c in candidates:
+        if maxMarkers is not None and len(markers) >= maxMarkers:
             break
-        else:
-            markers.append(marker)
 
-    return markers, blobs
+        # non-maximum suppression
+        if len(accepted) > 0 and \
+           np.min(np.sqrt(np.sum((accepted - centers[c]) ** 2, axis=1))) < radii[c]:
+            continue
+
+        center, members = fitMarkerRing(coords, centers[c], radii[c], distanceTolerance, ~assigned)
+        if center is None:
+            continue
+
+        temp_marker = marker(radii[c])
+        for k in np.where(members)[0]:
+            temp_marker.addBlob(blobs[k])
+        temp_marker.pos = tuple(center)
+        markers.append(temp_marker)
+
+        assigned |= members
+        accepted = np.vstack((accepted, center))
+
+    blobs_unused = [blobs[k] for k in np.where(~assigned)[0]]
+
+    return markers, blobs_unused
 
 
 '''
@@ -406,18 +588,8 @@ def extractCode(img, markerRadius, distTolerance=3):
     # print(trueDots)
 
     # find marker center from the true dots
-    data = [[], []]
-    for i in trueDots:
-        data[0].append(i[0])
-        data[1].append(i[1])
-
-    try:
-        lsqe = ellipses.LSqEllipse()
-        lsqe.fit(data)
-        center, width, height, phi = lsqe.parameters()
-    except(IndexError):
-        center = markerCenter
-    except(np.linalg.linalg.LinAlgError):
+    center, _ = fitCircle(trueDots, radius=markerRadius, center=markerCenter)
+    if not np.all(np.isfinite(center)):
         center = markerCenter
     # print('circle center: ', tuple(center))
 
@@ -617,6 +789,23 @@ def cropImage(img, pos, radius, margin=4):
     return imgCropped
 
 
+def cropImageView(img, pos, radius, margin=4):
+    # view of the image region surrounded by circle, without copying.
+    # falls back to a zero padded copy from cropImage at the pad edges.
+    # returns the cropped image and its origin in img (None for copies)
+    crop_half = int(round(radius) + margin)
+    crop = crop_half * 2 + 1
+
+    xMin = int(pos[0]) - crop_half
+    yMin = int(pos[1]) - crop_half
+
+    if xMin >= 0 and yMin >= 0 and \
+       xMin + crop <= np.shape(img)[0] and yMin + crop <= np.shape(img)[1]:
+        return img[xMin:xMin + crop, yMin:yMin + crop], (xMin, yMin)
+    else:
+        return cropImage(img, pos, radius, margin=margin), None
+
+
 def excludeMarkerPeaks(img, pos, radius, margin=2):
     # crop image region surrounded by circle
     # img size
@@ -661,37 +850,94 @@ def excludeMarkerPeaks(img, pos, radius, margin=2):
     return img
 
 
-def calculateForceVector(img):
-    # calcuate vector of the applied force
-    width = np.shape(img)[0]
-    height = np.shape(img)[1]
-    centerP = np.floor(np.shape(img)[0] / 2)
+_offsetGrids = {}
 
-    vecX = 0
-    vecY = 0
 
-    x = np.linspace(0, width - 1, width)
-    y = np.linspace(0, height - 1, height)
+def getOffsetGrids(shape):
+    # x and y offsets of every pixel from the crop center, cached by crop shape
+    if shape not in _offsetGrids:
+        centerP = np.floor(shape[0] / 2)
+        yv, xv = np.indices(shape, dtype=np.float)
+        _offsetGrids[shape] = ((xv - centerP).ravel(), (yv - centerP).ravel())
+    return _offsetGrids[shape]
 
-    xv, yv = np.meshgrid(x, y)
 
-    vecMag = np.sqrt(np.power(xv - centerP, 2) + np.power(yv - centerP, 2))
-    vecRad = np.arctan2(xv - centerP, yv - centerP)
-    # print(np.sum(img))
-    img_sum = np.sum(img)
+def calculateForceVector(img):
+    # calcuate vector of the applied force
+    img = np.asarray(img)
+    offsetX, offsetY = getOffsetGrids(np.shape(img))
+    values = img.ravel()
+    img_sum = np.sum(values)
 
     if img_sum > 0:
-        vecX = np.sum(img * vecMag * np.sin(vecRad)) / img_sum
-        vecY = -np.sum(img * vecMag * np.cos(vecRad)) / img_sum
+        vecX = np.dot(values, offsetX) / img_sum
+        vecY = -np.dot(values, offsetY) / img_sum
     else:
         vecX = 0
         vecY = 0
-    # print(vecX, vecY)
 
     return (vecX, vecY)
 
 
-def detectBlobs(img, areaThreshold=1000, forceThreshold=6, binThreshold=2):
+class BlobBuffers:
+    # scratch images of detectBlobs and findLocalPeaks, reused across frames
+    # so the image stages do not allocate per frame
+
+    def __init__(self, shape, dtype=np.float):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        # force scaled for thresholding
+        self.scaled = np.zeros(shape, dtype=dtype)
+        self.uint8 = np.zeros(shape, dtype=np.uint8)
+        self.binary = np.zeros(shape, dtype=np.uint8)
+        # large blobs
+        self.mask = np.zeros(shape, dtype=np.uint8)
+        # local extrema of findLocalPeaks
+        self.localMax = np.zeros(shape, dtype=dtype)
+        self.localMin = np.zeros(shape, dtype=dtype)
+        self.peaks = np.zeros(shape, dtype=bool)
+        self.above = np.zeros(shape, dtype=bool)
+
+    def fits(self, img):
+        return img.shape == self.shape and img.dtype == self.dtype
+
+
+def findBlobContours(img, binThreshold=2, buffers=None):
+    # external contours of the force image, doubled and clipped to 255, thresholded at binThreshold
+    if buffers is None or not buffers.fits(img):
+        buffers = BlobBuffers(img.shape, img.dtype)
+    scaled = np.multiply(img, 2, out=buffers.scaled)
+    np.minimum(scaled, 255, out=scaled)
+    np.copyto(buffers.uint8, scaled, casting='unsafe')
+
+    # Binary threshold
+    img_bin = cv2.threshold(buffers.uint8,
+                            binThreshold,
+                            255,
+                            cv2.THRESH_BINARY,
+                            dst=buffers.binary)[1]
+    # find contours (OpenCV 3 returns the image as well)
+    contours, hierarchy = cv2.findContours(
+        img_bin,
+        cv2.RETR_EXTERNAL,
+        cv2.CHAIN_APPROX_SIMPLE
+    )[-2:]
+    return contours, hierarchy
+
+
+def blobForce(img, peak):
+    # force of a blob: sum of the raw force of the 3 x 3 pixels around its peak (row, col)
+    cropped = cropImage(img, peak, 1, margin=0)
+    if np.shape(cropped)[0] == 0:
+        return 0
+    return np.sum(cropped)
+
+
+def detectBlobs(img, areaThreshold=1000, forceThreshold=6, binThreshold=2, buffers=None):
+    # buffers: BlobBuffers of the image shape, reused across frames.
+    # the returned threshold image is then buffers.mask, overwritten by the next call
+    if buffers is None or not buffers.fits(img):
+        buffers = BlobBuffers(img.shape, img.dtype)
 
     contours = []
     hierarchy = []
@@ -702,45 +948,36 @@ def detectBlobs(img, areaThreshold=1000, forceThreshold=6, binThreshold=2):
     # pixelpoints = []
     forces = []
     blobs = []
-    img_thre = np.zeros_like(img)
+    img_thre = buffers.mask
+    img_thre.fill(0)
 
-    if np.max(img) > 0:
+    # reduce over the flat view, a 2d reduction allocates an iteration buffer
+    if np.max(img.ravel()) > 0:
         # img_uint8 = np.zeros_like(img, dtype=np.uint8)
         # img_uint8 = (img / np.max(img) * 255).astype(np.uint8)
-        img_thre = copy.deepcopy(img) * 2
-        img_thre[img_thre >= 255] = 255
-        img_thre = img_thre.astype(np.uint8)
-
-        # Binary threshold
-        img_thre = cv2.threshold(img_thre,
-                                 binThreshold,
-                                 255,
-                                 cv2.THRESH_BINARY)[1]
-        # find contours
-        _, contours, hierarchy = cv2.findContours(
-            img_thre,
-            cv2.RETR_EXTERNAL,
-            cv2.CHAIN_APPROX_SIMPLE
-        )
+        with timing.timer.span('findContours'):
+            contours, hierarchy = findBlobContours(img, binThreshold, buffers)
 
         # find peaks
-        img_peaks = findLocalPeaks(img, threshold=0.2).astype(np.uint8)
+        with timing.timer.span('findLocalPeaks'):
+            img_peaks = findLocalPeaks(img, threshold=0.2, buffers=buffers).view(np.uint8)
 
         # remove peaks which are included in large blobs
         # make masks for blobs over area threshold
-        mask = np.zeros(img.shape, dtype=np.uint8)
-        for cnt in contours:
-            # print(cnt)
-            area = cv2.contourArea(cnt)
-            # print(area)
-            if area > areaThreshold:
-                cv2.drawContours(mask, [cnt], 0, 255, -1)
-        img_peaks = cv2.subtract(img_peaks, mask)
-        img_thre = mask
+        with timing.timer.span('areaMask'):
+            mask = img_thre
+            for cnt in contours:
+                # print(cnt)
+                area = cv2.contourArea(cnt)
+                # print(area)
+                if area > areaThreshold:
+                    cv2.drawContours(mask, [cnt], 0, 255, -1)
+            img_peaks = cv2.subtract(img_peaks, mask, dst=img_peaks)
 
         # extract coordinates from peak image
-        peaks = findPeakCoord(img_peaks)
-        sub_peaks = findSubpixelPeaks(peaks, img, n=5)
+        with timing.timer.span('findSubpixelPeaks'):
+            peaks = findPeakCoord(img_peaks)
+            sub_peaks = findSubpixelPeaks(peaks, img, n=5)
 
         for peak in zip(peaks, sub_peaks):
 
@@ -749,12 +986,7 @@ def detectBlobs(img, areaThreshold=1000, forceThreshold=6, binThreshold=2):
             cys.append(peak[1][1])
 
             # force calculation
-            cropped = cropImage(img, (peak[0][0], peak[0][1]), 1, margin=0)
-            if np.shape(cropped)[0] == 0 or np.shape(cropped)[0] == 0:
-                force = 0
-            else:
-                # calculate force from the raw input image
-                force = np.sum(cropped)
+            force = blobForce(img, peak[0])
             forces.append(force)
 
             # create blob objects
@@ -860,10 +1092,17 @@ class Blob:
 
 
 class TrackBlobs():
-    def __init__(self):
+    def __init__(self, areaThreshold=1000, forceThreshold=6, binThreshold=2):
         # set initial parameters
         self.nextID = 0
         self.prevBlobs = []
+
+        # thresholds of detectBlobs
+        self.areaThreshold = areaThreshold
+        self.forceThreshold = forceThreshold
+        self.binThreshold = binThreshold
+        # scratch images of detectBlobs, allocated on the first frame
+        self.buffers = None
         # self.IDTable = [False] * 1000
 
     # def registerID(self, blob):
@@ -876,9 +1115,26 @@ class TrackBlobs():
 
     #     return blob
 
-    def update(self, img):
-        # find blobs in current frame
-        self.currentBlobs = detectBlobs(img, areaThreshold=1000)[0]
+    def update(self, img, timestamp=None):
+        # timestamp: time of the frame, the current time if None
+        with timing.timer.span('TrackBlobs.update'):
+            if self.buffers is None or not self.buffers.fits(img):
+                self.buffers = BlobBuffers(img.shape, img.dtype)
+            # find blobs in current frame
+            return self.track(detectBlobs(img,
+                                          areaThreshold=self.areaThreshold,
+                                          forceThreshold=self.forceThreshold,
+                                          binThreshold=self.binThreshold,
+                                          buffers=self.buffers)[0], timestamp)
+
+    def track(self, blobs, timestamp=None):
+        # match blobs of the current frame with the previous ones
+        # timestamp: time of the frame, replaces the creation time of the blobs.
+        #     tracking then only depends on the frames and their timestamps
+        self.currentBlobs = blobs
+        if timestamp is not None:
+            for b in blobs:
+                b.t_appeared = timestamp
 
         # no blobs in the image
         if len(self.currentBlobs) == 0:
@@ -980,6 +1236,8 @@ class marker:
     # delta cof_y
     # rotation: orientation of marker (0-2pi)
     # delta rotation
+    # rot_unwrapped: cumulative rotation over multiple turns
+    # v_rot: smoothed angular velocity (rad/s)
 
     def __init__(self, radius):
         self.n = 15
@@ -995,6 +1253,7 @@ class marker:
         self.timestamp = time.time()
 
         self.blobs = []
+        self.blobPhases = np.zeros(0)  # blob phases sorted in order of self.blobs
 
         self.slots = [None] * self.n
 
@@ -1019,6 +1278,14 @@ class marker:
         self.kernal_cof[mask_cof_outer] = 1
         self.kernal_cof[mask_cof_inner] = 0
 
+        # offsets of the center of force kernal pixels from the crop center
+        offsetX, offsetY = getOffsetGrids((size, size))
+        self.cofOffsetX = offsetX[np.flatnonzero(self.kernal_cof)]
+        self.cofOffsetY = offsetY[np.flatnonzero(self.kernal_cof)]
+
+        # flat kernal indices, cached by the row length of the image they index
+        self.kernalIndices = {}
+
         self.uniqueCodes = [
             # np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0], dtype=np.int),
             # np.array([1, 0, 0, 0, 1, 0, 1, 1, 1, 0, 0, 0, 0, 1, 0], dtype=np.int),
@@ -1131,43 +1398,44 @@ class marker:
 
         self.rot = 0
         self.d_rot = 0
+        self.rotConfidence = 0  # mean resultant length of blob rotations (0-1)
+        self.rotConfidenceThreshold = 0.8
+        self.rot_unwrapped = 0  # cumulative rotation over multiple turns
+        self.v_rot = 0  # smoothed angular velocity (rad/s)
+        self.rotSmoothing = 10.0  # smoothing rate of v_rot (1/s)
+        self.t_rot = None  # time of the last rotation update
 
         self.lifetime = 0
 
     def addBlob(self, blob):
         self.blobs.append(blob)
 
-    def calculateMarkerCenter(self):
-        temp_centers = []
-        for blobs_two in itertools.combinations(self.blobs, 2):
-            center1, center2 = findCircles((blobs_two[0].c, blobs_two[1].c), self.radius)
-            centers = [center1, center2]
-            for cnt in centers:
-                if distance(self.pos, cnt) < self.radius:
-                    # return tuple(cnt)
-                    temp_centers.append(cnt)
-
-        # print(temp_centers)
-        if len(temp_centers) > 0:
-            pos = np.sum(temp_centers, axis=0) / len(temp_centers)
-            return pos
+    def calculateMarkerCenter(self, center=None):
+        # fit a circle of the marker radius to the blobs, starting from the current position.
+        # center: precomputed fit, e.g. from fitMarkerCenters
+        if center is None:
+            center, _ = fitCircle([b.c for b in self.blobs], radius=self.radius, center=self.pos)
+
+        if np.all(np.isfinite(center)) and distance(self.pos, center) < self.radius:
+            return tuple(center)
         else:
             return self.pos
 
-    def update(self, blobs, img):
+    def update(self, blobs, img, center=None, timestamp=None):
+        # timestamp: time of the frame, the current time if None
         # print([b.slot for b in self.blobs])
         # update blob positions
         temp_blobs = []
         for b_exist in self.blobs:
             # find blobs by ID
             for b in blobs:
-                if b_exist.ID is b.ID:
+                if b_exist.ID == b.ID:
                     b.slot = b_exist.slot  # succeed slot index
                     temp_blobs.append(b)
 
         # update center coordinate
         prev_pos = self.pos
-        self.pos = self.calculateMarkerCenter()
+        self.pos = self.calculateMarkerCenter(center)
         self.pos_x = self.pos[0]
         self.pos_y = self.pos[1]
 
@@ -1178,7 +1446,7 @@ class marker:
 
         self.blobs = temp_blobs
 
-        self.markerImg = cropImage(img, self.pos[::-1], self.radius, margin=5)
+        self.setROI(img)
 
         self.code, self.phaseError = self.extractCode()
 
@@ -1207,70 +1475,47 @@ class marker:
                     self.ID_fixed = True
                     # print('fixed ID!')
         else:
-            prev_rot = self.rot
-            self.calculateRotation()
-            self.d_rot = self.rot - prev_rot
+            self.updateRotation(timestamp)
             self.findSlots()
 
         # self.lifetime = 0
     def extractCode(self):
         # make the dots as vectors from center point
-        blobPhases = []
-        for b in self.blobs:
-            vector = (b.c[0] - self.pos[0], b.c[1] - self.pos[1])
-            try:
-                vectorPhase = np.arctan2(vector[0], vector[1]) % (2 * np.pi)
-            except TypeError:
-                vectorPhase = np.arctan2(np.real(vector[0]), np.real(vector[1]))
-            b.phase = vectorPhase
-            blobPhases.append(vectorPhase)
-        # print(np.rad2deg(vectorPhase) % (360 / 15))
-        blobPhases = np.array(blobPhases, dtype=np.float)
-        # print(blobPhases)
-        # print(np.argsort(blobPhases, axis=0))
-        # print('before sort')
-        # for b in self.blobs:
-        #     print(b.c)
-        # self.blobs = [x for _, x in sorted(zip(blobPhases.tolist(), self.blobs))]
-        self.blobs = np.array(self.blobs)[np.argsort(blobPhases)].tolist()
-        # for i in range(len(self.blobs)):
-        #     self.blobs[i].slot = i
-        # print('after sort')
-        # for b in self.blobs:
-        #     print(b.c)
-        blobPhases = np.sort(blobPhases)
-
-        phaseError = 0
-        if len(blobPhases) > 0:
-            phaseError = blobPhases[0]
-            blobPhases = blobPhases - phaseError
-            # slots = np.linspace(0, (self.n - 1) * np.pi / self.n, num=self.n)
-            # print(slots)
-            # phsErrors = slots - np.array(blobPhases)
-            # print(phsErrors)
-
-        phaseErrors = []
-        code = []
-        for i in range(self.n):
-            if i == 0:
-                code.append(1)
-                phaseErrors.append(0)
-            else:
-                isDot = False
-                for phs in blobPhases:
-                    if phs > np.pi / self.n * (2 * i - 1) and \
-                       phs < np.pi / self.n * (2 * i + 1):
-                        isDot = True
-                        code.append(1)
-                        phaseErrors.append(i * 2 * np.pi / self.n - phs)
-                        break
-                if not isDot:
-                    code.append(0)
-                    phaseErrors.append(0)
-
+        code = np.zeros(self.n, dtype=np.int)
+        code[0] = 1
+        if len(self.blobs) == 0:
+            self.blobPhases = np.zeros(0)
+            return code, 0
+
+        coords = np.array([b.c for b in self.blobs], dtype=np.float)
+        blobPhases = np.arctan2(coords[:, 0] - self.pos[0],
+                                coords[:, 1] - self.pos[1]) % (2 * np.pi)
+
+        # sort blobs in order of phase
+        order = np.argsort(blobPhases)
+        blobPhases = blobPhases[order]
+        self.blobs = [self.blobs[i] for i in order]
+        for b, phs in zip(self.blobs, blobPhases):
+            b.phase = phs
+        self.blobPhases = blobPhases
+
+        # phases relative to the first blob, binned into slots of 2pi / n
+        phaseError = blobPhases[0]
+        relPhases = blobPhases - phaseError
+        bins = np.floor(relPhases / (2 * np.pi / self.n) + 0.5).astype(np.int)
+
+        # bins are sorted, so the first blob of each bin is the closest to its lower edge.
+        # slot 0 is occupied by the reference blob itself.
+        slots, first = np.unique(bins, return_index=True)
+        valid = (slots > 0) & (slots < self.n)
+        slots = slots[valid]
+        first = first[valid]
+        code[slots] = 1
+
+        phaseErrors = slots * 2 * np.pi / self.n - relPhases[first]
         phaseError = phaseError + np.sum(phaseErrors) / self.n
 
-        return np.array(code, dtype=np.int), phaseError
+        return code, phaseError
 
     def checkIDConfidence(self):
         # check for the marker retrieval condition
@@ -1282,16 +1527,42 @@ class marker:
         else:
             return False
 
-    def sumForce(self):
-        # print(np.shape(mask))
-        img_masked = self.markerImg * self.kernal_f
+    def getKernalIndices(self, width):
+        # flat indices of the force and center of force kernals
+        # for an image with rows of the given width
+        if width not in self.kernalIndices:
+            rows_f, cols_f = np.nonzero(self.kernal_f)
+            rows_cof, cols_cof = np.nonzero(self.kernal_cof)
+            self.kernalIndices[width] = (rows_f * width + cols_f,
+                                         rows_cof * width + cols_cof)
+        return self.kernalIndices[width]
+
+    def setROI(self, img):
+        # marker region of the frame. a view where the marker is fully inside the pad
+        self.markerImg, origin = cropImageView(img, self.pos[::-1], self.radius, margin=5)
+
+        if origin is not None and img.flags['C_CONTIGUOUS']:
+            # index the frame directly from the top left pixel of the region
+            width = np.shape(img)[1]
+            self.roiFlat = img.ravel()[origin[0] * width + origin[1]:]
+        else:
+            width = np.shape(self.markerImg)[1]
+            self.roiFlat = np.ascontiguousarray(self.markerImg).ravel()
+        self.roiIndex_f, self.roiIndex_cof = self.getKernalIndices(width)
 
-        return np.sum(img_masked)
+    def sumForce(self):
+        # sum of pixels in the force kernal
+        return np.sum(np.take(self.roiFlat, self.roiIndex_f))
 
     def calculateCOF(self):
         # mask to exclude misc blobs
-        img_masked = self.markerImg * self.kernal_cof
-        return calculateForceVector(img_masked)
+        values = np.take(self.roiFlat, self.roiIndex_cof)
+        img_sum = np.sum(values)
+        if img_sum > 0:
+            return (np.dot(values, self.cofOffsetX) / img_sum,
+                    -np.dot(values, self.cofOffsetY) / img_sum)
+        else:
+            return (0, 0)
 
     def recognizeID(self):
         IDout = 0
@@ -1336,60 +1607,88 @@ class marker:
             # print(b.slot)
 
     def findSlots(self):
-        for b in self.blobs:
-            if b.slot < 0:
-                # print(b.phase, self.rot)
-                try:
-                    b.slot = np.round((b.phase - self.rot) / (2 * np.pi / self.n)) % self.n
-                except ValueError:
-                    b.slot = -1
+        # assign slots to blobs which appeared after the ID was fixed
+        if len(self.blobs) == 0:
+            return
+        slots = np.array([b.slot for b in self.blobs])
+        unassigned = np.where(slots < 0)[0]
+        if len(unassigned) > 0:
+            newSlots = circular.nearestSlots(self.blobPhases[unassigned], self.rot, self.n)
+            for i, slot in zip(unassigned, newSlots):
+                self.blobs[i].slot = slot
+
+    def updateRotation(self, timestamp=None):
+        # update rotation with its unwrapped value and angular velocity
+        prev_rot = self.rot
+        if not self.calculateRotation():
+            self.d_rot = 0
+            return
+
+        now = time.time() if timestamp is None else timestamp
+        if self.t_rot is None:
+            # first rotation after the ID was fixed
+            self.rot_unwrapped = self.rot
+            self.d_rot = 0
+        else:
+            # wrapped difference does not jump at the 0 / 2pi seam
+            self.d_rot = circular.angleDifference(self.rot, prev_rot)
+            self.rot_unwrapped += self.d_rot
+            dt = now - self.t_rot
+            if dt > 0:
+                s = np.clip(dt * self.rotSmoothing, 0, 1)
+                self.v_rot = self.v_rot * (1 - s) + (self.d_rot / dt) * s
+        self.t_rot = now
 
     def calculateRotation(self):
-        vector_x = []
-        vector_y = []
-        # print(self.blobs)
-        if len(self.blobs) > 0:
-            for b in self.blobs:
-                if b.slot > -1:
-                    phase_shift = (b.phase - b.slot * 2 * np.pi / self.n) % (2 * np.pi)
-                    vector_x.append(np.cos(phase_shift))
-                    vector_y.append(np.sin(phase_shift))
-
-            vector_x_avg = np.average(vector_x)
-            vector_y_avg = np.average(vector_y)
-            # print(vector_x_avg, vector_y_avg)
-
-            if np.isnan(vector_x_avg) or np.isnan(vector_y_avg):
-                self.rot = self.rot
-                return True
-                # vector_x_avg = 0
-            # if np.isnan(vector_y_avg):
-                # vector_y_avg = 0
+        # circular mean of the rotation implied by every slotted blob
+        if len(self.blobs) == 0:
+            return False
 
-            try:
-                rot = (np.arctan2(vector_y_avg, vector_x_avg)) % (2 * np.pi)
-            except RuntimeWarning:
-                self.rot = self.rot
-            else:
-                self.rot = rot
-        else:
-            self.rot = self.rot
+        slots = np.array([b.slot for b in self.blobs])
+        slotted = slots > -1
+        rot, confidence = circular.circularMean(
+            circular.slotOffsets(self.blobPhases[slotted], slots[slotted], self.n)
+        )
+        self.rotConfidence = confidence
+
+        # skip noisy frames, where blobs disagree on the rotation
+        if confidence < self.rotConfidenceThreshold:
+            return False
+
+        self.rot = rot
+        return True
+
+
+def fitMarkerCenters(markers):
+    # fit centers of all markers to their blobs in a single batched circle fit
+    if len(markers) == 0:
+        return np.zeros((0, 2))
+    points = [b.c for mkr in markers for b in mkr.blobs]
+    offsets = np.cumsum([0] + [len(mkr.blobs) for mkr in markers])
+    centers, _ = fitCircles(points,
+                            offsets,
+                            radius=[mkr.radius for mkr in markers],
+                            centers=[mkr.pos for mkr in markers])
+    return centers
 
 
 class TrackMarkers():
-    def __init__(self, radii):
+    def __init__(self, radii, distanceTolerance=1):
         # set initial parameters
         self.markers = []
         self.radii = radii
-        self.distanceTolerance = 1
+        self.distanceTolerance = distanceTolerance
 
         self.t_threshold = 0.5
 
-    def update(self, img, blobs):
+    def update(self, img, blobs, timestamp=None):
+        # timestamp: time of the frame, the current time if None
         # for existing markers, update their information and exclude the marker's blobs from current blobs
         blobs_mkr = []
-        for mkr in self.markers:
-            mkr.update(blobs, img)
+        centers = fitMarkerCenters(self.markers)
+        for mkr, center in zip(self.markers, centers):
+            with timing.timer.span('marker.update'):
+                mkr.update(blobs, img, center=center, timestamp=timestamp)
             for b in mkr.blobs:
                 blobs_mkr.append(b)
         self.blobs_unused = [blob for blob in blobs if blob not in blobs_mkr]
@@ -1407,7 +1706,7 @@ class TrackMarkers():
         self.blobs_unused = [blob for blob in self.blobs_unused if blob not in blobs_mkr]
 
         # for recent blobs, find marker centers
-        self.t_current = time.time()
+        self.t_current = time.time() if timestamp is None else timestamp
 
         # filter recent blobs
         # self.blobs = blobs
@@ -1422,9 +1721,11 @@ class TrackMarkers():
         temp_markers = []
         new_markers = []
         if len(self.recent_blobs) > 3:
-            new_markers, blobs_unused = findMarker(self.recent_blobs, markerRadii=self.radii, distanceTolerance=self.distanceTolerance)
+            with timing.timer.span('findMarker'):
+                new_markers, blobs_unused = findMarker(self.recent_blobs, markerRadii=self.radii, distanceTolerance=self.distanceTolerance)
             for mkr in new_markers:
-                mkr.update(blobs, img)
+                with timing.timer.span('marker.update'):
+                    mkr.update(blobs, img, timestamp=timestamp)
                 # print('pos:', mkr.pos)
 
         # print('new markers:', new_markers)
@@ -9,13 +9,10 @@ except NameError:
 
 import sys
 import numpy as np
-import cv2
 from pythonosc import osc_message_builder
 from pythonosc import udp_client
-from oscpy.client import OSCClient
 
 import argparse
-from copy import deepcopy
 
 # from pyqtgraph.Qt import QtCore, QtGui
 from PyQt5 import QtCore, QtGui, QtWidgets
@@ -24,6 +21,8 @@ from pyqtgraph.ptime import time
 
 import sensel_control as sc
 import forcestamp
+import output
+import timing
 
 from forcestamp_ui import Ui_MainWindow
 
@@ -141,23 +140,6 @@ class MarkerPopupWidget(QtWidgets.QWidget):
                 qp.end()
 
 
-class IDparameter:
-    def __init__(self):
-        self.posx_max = 100.0
-        self.posx_min = 0.0
-        self.posy_max = 100.0
-        self.posy_min = 0.0
-        self.force_max = 100.0
-        self.force_min = 0.0
-        self.cof_x_max = 100.0
-        self.cof_x_min = -100.0
-        self.cof_y_max = 100.0
-        self.cof_y_min = -100.0
-
-    def printParameters(self):
-        print(self.posx_max, self.posx_min, self.posy_max, self.posy_min, self.force_max, self.force_min, self.cof_x_max, self.cof_x_min, self.cof_y_max, self.cof_y_min)
-
-
 class MarkerPopupSignals(QtCore.QObject):
     # SIGNALS
     OPEN = QtCore.pyqtSignal()
@@ -171,9 +153,8 @@ class ForceStamp (QtWidgets.QWidget):
         self.ui = Ui_MainWindow()  # import GUI layout
         self.ui.setupUi(self)  # initalization
 
-        # param names
-        self.param_names = ['posx_max', 'posx_min', 'posy_max', 'posy_min', 'force_max',
-                            'force_min', 'cof_x_max', 'cof_x_min', 'cof_y_max', 'cof_y_min']
+        # param names, columns of IDparam
+        self.param_names = output.PARAM_NAMES
 
         # Morph size
         self.rows = 185
@@ -193,7 +174,7 @@ class ForceStamp (QtWidgets.QWidget):
 
         # initailize ID scale parameters
         self.IDs = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 51, 80, 101]
-        self.IDparam = [IDparameter() for count in range(self.num_ID)]
+        self.IDparam = output.IDParameters(self.num_ID)
 
         # initialize force image
         self.initViewBox()
@@ -226,7 +207,8 @@ class ForceStamp (QtWidgets.QWidget):
         address = '127.0.0.1'
         # address = '192.168.0.3'
         port = 12000
-        self.osc = OSCClient(address, port)
+        # OSC is sent from a background thread, so a slow receiver does not delay the next frame
+        self.output = output.AsyncSink([output.OSCOutput(address, port)])
 
 
         # update interval
@@ -240,6 +222,15 @@ class ForceStamp (QtWidgets.QWidget):
         self.timer.timeout.connect(self.updateData)
         # self.timer.start(self.interval)
 
+        # the display is refreshed on its own timer with the latest frame,
+        # so detection runs as fast as the Morph delivers frames
+        self.displayRate = 60  # Hz
+        self.displayTimer = QtCore.QTimer()
+        self.displayTimer.timeout.connect(self.updateDisplay)
+        self.displayFrame = None
+        self.displayBlobs = []
+        self.displayDirty = False
+
         # marker information popup
         self._popframe = None
         self._popflag = False
@@ -252,18 +243,19 @@ class ForceStamp (QtWidgets.QWidget):
 
     def updateData(self):
         # scan image from the device
-        try:
-            self.f_image = sc.scan_frames(self.handle, self.frame, self.info)
-        except(UnboundLocalError):
+        with timing.timer.span('acquisition'):
             try:
-                sc.close_sensel(self.handle, self.frame)
-                # Open Morph
-                self.handle, self.i = sc.open_sensel()
-                # Initalize frame
-                self.frame = sc.init_frame(self.handle, baseline=0)
                 self.f_image = sc.scan_frames(self.handle, self.frame, self.info)
             except(UnboundLocalError):
-                self.f_image = np.zeros((self.rows, self.cols))
+                try:
+                    sc.close_sensel(self.handle, self.frame)
+                    # Open Morph
+                    self.handle, self.i = sc.open_sensel()
+                    # Initalize frame
+                    self.frame = sc.init_frame(self.handle, baseline=0)
+                    self.f_image = sc.scan_frames(self.handle, self.frame, self.info)
+                except(UnboundLocalError):
+                    self.f_image = np.zeros((self.rows, self.cols))
 
         # update blob information
         self.blobs = self.BlobTracker.update(self.f_image)
@@ -282,14 +274,15 @@ class ForceStamp (QtWidgets.QWidget):
                 self.SIGNALS.CLOSE.emit()
 
         # send marker parameters to GUI
-        self.sendMarkerParameters()
+        with timing.timer.span('osc'):
+            self.sendMarkerParameters()
 
         '''
         # retrieve peak coordinates from the peak image
         self.peaks = forcestamp.findPeakCoord(self.f_image_peaks)
 
         # exclude marker areas from the peak coords
-        self.f_image_peaks_excluded = deepcopy(self.f_image_peaks)
+        self.f_image_peaks_excluded = self.f_image_peaks.copy()
         for mkr in self.markers:
             self.f_image_peaks_excluded = forcestamp.excludeMarkerPeaks(self.f_image_peaks_excluded, (mkr.pos_y, mkr.pos_x), mkr.radius)
         self.peaks_excluded = forcestamp.findPeakCoord(self.f_image_peaks_excluded)
@@ -304,25 +297,13 @@ class ForceStamp (QtWidgets.QWidget):
             self.sendOSC_coords(self.peaks_excluded, self.peaks_force)
         '''
 
-        # prepare a image copy for display
-        f_image_show = deepcopy(self.f_image)
-        if np.max(f_image_show) > 0:
-            f_image_show = f_image_show / np.max(f_image_show) * 255
-        f_image_show = cv2.cvtColor(f_image_show.astype(np.uint8), cv2.COLOR_GRAY2RGB)
-
-        # draw peaks
-        for b in self.blobs:
-            cv2.circle(
-                f_image_show,
-                (np.int(b.cx), np.int(b.cy)),
-                0,
-                (0, 255, 255)
-            )
-
-        # set image for display
-        self.img.setImage(np.rot90(f_image_show, 3), autoLevels=True, levels=(0, 50))
+        # hand the latest frame to the display
+        self.displayFrame = self.f_image
+        self.displayBlobs = self.blobs
+        self.displayDirty = True
 
         # self.calculateFPS()
+        timing.timer.endFrame()
         QtGui.QApplication.processEvents()
 
     def onStartButton(self):
@@ -345,6 +326,36 @@ class ForceStamp (QtWidgets.QWidget):
             # self.timer = QtCore.QTimer()
             # self.timer.timeout.connect(self.updateData)
             self.timer.start(self.interval)
+            self.displayTimer.start(int(1000 / self.displayRate))
+
+    def updateDisplay(self):
+        # show the latest processed frame, scaled to uint8 in preallocated buffers
+        if not self.displayDirty:
+            return
+        self.displayDirty = False
+        f_image = self.displayFrame
+        if self.displayScratch.shape != f_image.shape:
+            self.allocateDisplay(f_image.shape)
+
+        peak = f_image.max()
+        if peak > 0:
+            np.multiply(f_image, 255.0 / peak, out=self.displayScratch)
+        else:
+            self.displayScratch.fill(0)
+        np.copyto(self.displayImage, self.displayScratch, casting='unsafe')
+
+        # rot90 is a view, the image item is shown with x along the Morph columns
+        self.img.setImage(np.rot90(self.displayImage, 3), autoLevels=False, levels=(0, 255))
+
+        # peaks at pixel centers of the rotated image
+        height = f_image.shape[0]
+        coords = np.array([b.c for b in self.displayBlobs], dtype=float).reshape(-1, 2)
+        self.blobScatter.setData(x=coords[:, 0] + 0.5, y=height - 0.5 - coords[:, 1])
+
+    def allocateDisplay(self, shape):
+        # display buffers reused for every frame
+        self.displayScratch = np.zeros(shape)
+        self.displayImage = np.zeros(shape, dtype=np.uint8)
 
     def resizeEvent(self, event):
         if self._popflag:
@@ -380,28 +391,20 @@ class ForceStamp (QtWidgets.QWidget):
         currentState = [0] * self.num_ID
 
         # self.sendOSC(len(self.MarkerTracker.markers), '/num')
-        self.osc.send_message(b'/num', [len(self.MarkerTracker.markers)])
         # self.sendOSC([0.0, 0.0, 0.1], 'pos_x')
-        pos_x = []
-        pos_y = []
-        force = []
-        cof_x = []
-        cof_y = []
-        angle = []
-        id_list = []
-        radius = []
-
-        for mkr in self.MarkerTracker.markers:
-            # mkr.pos_y = 104 - mkr.pos_y
-            # mkr.force = mkr.sumForce()
-            # (mkr.cof_x, mkr.cof_y) = mkr.vectorForce()
-            # mkr.cof_y *= -1
-            mkr.pos_x_scaled = (self.IDparam[mkr.ID].posx_max - self.IDparam[mkr.ID].posx_min) * ((forcestamp.constraint(mkr.pos_x, posx_min, posx_max) - posx_min) / (posx_max - posx_min)) + self.IDparam[mkr.ID].posx_min
-            mkr.pos_y_scaled = (self.IDparam[mkr.ID].posy_max - self.IDparam[mkr.ID].posy_min) * ((forcestamp.constraint(self.cols - mkr.pos_y, posy_min, posy_max) - posy_min) / (posy_max - posy_min)) + self.IDparam[mkr.ID].posy_min
-            mkr.force_scaled = (self.IDparam[mkr.ID].force_max - self.IDparam[mkr.ID].force_min) * ((forcestamp.constraint(mkr.force, force_min, self.force_sensitivity) - force_min) / (self.force_sensitivity - force_min)) + self.IDparam[mkr.ID].force_min
-            mkr.cof_x_scaled = (self.IDparam[mkr.ID].cof_x_max - self.IDparam[mkr.ID].cof_x_min) * ((forcestamp.constraint(mkr.cof_x, cof_x_min, cof_x_max) - cof_x_min) / (cof_x_max - cof_x_min)) + self.IDparam[mkr.ID].cof_x_min
-            mkr.cof_y_scaled = (self.IDparam[mkr.ID].cof_y_max - self.IDparam[mkr.ID].cof_y_min) * ((forcestamp.constraint(mkr.cof_y, cof_y_min, cof_y_max) - cof_y_min) / (cof_y_max - cof_y_min)) + self.IDparam[mkr.ID].cof_y_min
 
+        # marker fields of this frame, scaled for all markers at once
+        records = output.markerRecords(self.MarkerTracker.markers)
+        values = np.column_stack((records.pos_x, self.cols - records.pos_y, records.force,
+                                  records.cof_x, records.cof_y))
+        inputRanges = [[posx_min, posx_max],
+                       [posy_min, posy_max],
+                       [force_min, self.force_sensitivity],
+                       [cof_x_min, cof_x_max],
+                       [cof_y_min, cof_y_max]]
+        scaled = output.scaleParameters(values, records.ID, self.IDparam, inputRanges)
+
+        for i, mkr in enumerate(self.MarkerTracker.markers):
             # store current state
             currentState[mkr.ID] = 1
 
@@ -420,28 +423,20 @@ class ForceStamp (QtWidgets.QWidget):
             # self.sendOSC(np.rad2deg(mkr.d_rot), '/m' + str(mkr.ID) + '/d_rot')
             # self.sendOSC(mkr.ID, '/m' + str(mkr.ID) + '/id')
             # osc.send_message(b'/ids', id_list)
-            pos_x.append(mkr.pos_x)
-            pos_y.append(mkr.pos_y)
-            force.append(mkr.force)
-            cof_x.append(mkr.cof_x)
-            cof_y.append(mkr.cof_y)
-            # angle.append(np.rad2deg(mkr.rot))
-            angle.append(mkr.rot)
-            id_list.append(mkr.ID)
-            radius.append(mkr.radius)
-
-            if self.currentID == mkr.ID and mkr.ID is not 0:
+
+            if self.currentID == mkr.ID and mkr.ID != 0:
                 # send current parameters
-                self.ui.progressBar_posx.setValue(mkr.pos_x_scaled * 10)
-                self.ui.progressBar_posy.setValue(mkr.pos_y_scaled * 10)
-                self.ui.progressBar_force.setValue(mkr.force_scaled * 10)
-                self.ui.progressBar_cof_x.setValue(mkr.cof_x_scaled * 10)
-                self.ui.progressBar_cof_y.setValue(mkr.cof_y_scaled * 10)
-                self.ui.value_posx.setText(('%.01f' % mkr.pos_x_scaled))
-                self.ui.value_posy.setText(('%.01f' % mkr.pos_y_scaled))
-                self.ui.value_force.setText(('%.01f' % mkr.force_scaled))
-                self.ui.value_cof_x.setText(('%.01f' % mkr.cof_x_scaled))
-                self.ui.value_cof_y.setText(('%.01f' % mkr.cof_y_scaled))
+                pos_x_scaled, pos_y_scaled, force_scaled, cof_x_scaled, cof_y_scaled = scaled[i]
+                self.ui.progressBar_posx.setValue(pos_x_scaled * 10)
+                self.ui.progressBar_posy.setValue(pos_y_scaled * 10)
+                self.ui.progressBar_force.setValue(force_scaled * 10)
+                self.ui.progressBar_cof_x.setValue(cof_x_scaled * 10)
+                self.ui.progressBar_cof_y.setValue(cof_y_scaled * 10)
+                self.ui.value_posx.setText(('%.01f' % pos_x_scaled))
+                self.ui.value_posy.setText(('%.01f' % pos_y_scaled))
+                self.ui.value_force.setText(('%.01f' % force_scaled))
+                self.ui.value_cof_x.setText(('%.01f' % cof_x_scaled))
+                self.ui.value_cof_y.setText(('%.01f' % cof_y_scaled))
 
         # self.sendOSC(pos_x, '/pos_x')
         # self.sendOSC(pos_y, '/pos_y')
@@ -451,14 +446,8 @@ class ForceStamp (QtWidgets.QWidget):
         # self.sendOSC(angle, '/angle')
         # self.sendOSC(id_list, '/id')
         # self.sendOSC(radius, '/radius')
-        self.osc.send_message(b'/pos_x', pos_x)
-        self.osc.send_message(b'/pos_y', pos_y)
-        self.osc.send_message(b'/force', force)
-        self.osc.send_message(b'/cof_x', cof_x)
-        self.osc.send_message(b'/cof_y', cof_y)
-        self.osc.send_message(b'/angle', angle)
-        self.osc.send_message(b'/id', id_list)
-        self.osc.send_message(b'/radius', radius)
+        # all marker fields of the frame in one OSC bundle
+        self.output.send(records)
 
         # # send OSC messages when markers disappear
         # index = np.where((np.asarray(self.prevState, dtype=np.int8) - np.asarray(currentState, dtype=np.int8)) == 1)
@@ -531,6 +520,11 @@ class ForceStamp (QtWidgets.QWidget):
         # self.ui.graphicsView.scale(50, 50)
         # view.setCentralWidget(viewBox)
         self.viewBox.addItem(self.img)
+
+        # blob peaks, drawn by the scene instead of into the image
+        self.blobScatter = pg.ScatterPlotItem(size=3, pen=None, brush=pg.mkBrush(0, 255, 255), pxMode=True)
+        self.viewBox.addItem(self.blobScatter)
+        self.allocateDisplay((self.cols, self.rows))
         self.viewBox.setAspectLocked(True)
         self.viewBox.setRange(QtCore.QRectF(0, 0, 185 * 1, 105 * 1), padding=0)
         self.viewBox.setMouseEnabled(x=False, y=False)
@@ -566,16 +560,8 @@ class ForceStamp (QtWidgets.QWidget):
 
     def onComboBoxActivated(self, text):
         # save current parameters
-        self.IDparam[self.currentID].posx_max = self.ui.doubleSpinBox_posx_max.value()
-        self.IDparam[self.currentID].posx_min = self.ui.doubleSpinBox_posx_min.value()
-        self.IDparam[self.currentID].posy_max = self.ui.doubleSpinBox_posy_max.value()
-        self.IDparam[self.currentID].posy_min = self.ui.doubleSpinBox_posy_min.value()
-        self.IDparam[self.currentID].force_max = self.ui.doubleSpinBox_force_max.value()
-        self.IDparam[self.currentID].force_min = self.ui.doubleSpinBox_force_min.value()
-        self.IDparam[self.currentID].cof_x_max = self.ui.doubleSpinBox_cof_x_max.value()
-        self.IDparam[self.currentID].cof_x_min = self.ui.doubleSpinBox_cof_x_min.value()
-        self.IDparam[self.currentID].cof_y_max = self.ui.doubleSpinBox_cof_y_max.value()
-        self.IDparam[self.currentID].cof_y_min = self.ui.doubleSpinBox_cof_y_min.value()
+        for i, name in enumerate(self.param_names):
+            self.IDparam[self.currentID, i] = self.paramSpinBox(name).value()
 
         # change current marker ID
         if text == 'ID':
@@ -583,27 +569,31 @@ class ForceStamp (QtWidgets.QWidget):
         else:
             self.currentID = int(text)
         # print(self.currentID)
-        # print(self.IDparam[self.currentID].printParameters())
+        # print(self.IDparam[self.currentID])
 
         # load ID parameters and apply to current controls
-        for name in self.param_names:
-            evaltext = 'self.ui.doubleSpinBox_' + name + '.setValue(self.IDparam[self.currentID].' + name + ')'
-            eval(evaltext)
+        for i, name in enumerate(self.param_names):
+            self.paramSpinBox(name).setValue(self.IDparam[self.currentID, i])
+
+    def paramSpinBox(self, name):
+        # spin box of a parameter in param_names
+        return getattr(self.ui, 'doubleSpinBox_' + name)
 
     def initSpinBox(self):
 
         for name in self.param_names:
-            eval('self.ui.doubleSpinBox_' + name + '.setRange(-1000, 1000)')
+            spinBox = self.paramSpinBox(name)
+            spinBox.setRange(-1000, 1000)
             if 'max' in name:  # if there's 'max' string
-                eval('self.ui.doubleSpinBox_' + name + '.setValue(100)')
+                spinBox.setValue(100)
             else:
                 if 'vec' in name:  # if the box is vector
-                    eval('self.ui.doubleSpinBox_' + name + '.setValue(-100)')
+                    spinBox.setValue(-100)
                 else:
-                    eval('self.ui.doubleSpinBox_' + name + '.setValue(0)')
-            eval('self.ui.doubleSpinBox_' + name + '.setDecimals(1)')
-            eval('self.ui.doubleSpinBox_' + name + '.setKeyboardTracking(False)')
-            eval('self.ui.doubleSpinBox_' + name + '.valueChanged.connect(self.onSpinBoxChanged)')
+                    spinBox.setValue(0)
+            spinBox.setDecimals(1)
+            spinBox.setKeyboardTracking(False)
+            spinBox.valueChanged.connect(self.onSpinBoxChanged)
 
         self.ui.doubleSpinBox_force_sens.setRange(0, 20000)
         self.ui.doubleSpinBox_force_sens.setValue(3000)
@@ -624,8 +614,7 @@ class ForceStamp (QtWidgets.QWidget):
         name = sender.objectName()
 
         # save current parameter
-        exectext = 'self.IDparam[self.currentID].' + name[14:] + ' = self.ui.' + name + '.value()'
-        exec(exectext)
+        self.IDparam[self.currentID, self.param_names.index(name[len('doubleSpinBox_'):])] = sender.value()
 
         self.updateProgressBarRange()
 
@@ -666,6 +655,9 @@ class ForceStamp (QtWidgets.QWidget):
 
     def closeEvent(self, event):
         print('Exit application')
+        self.output.close()
+        if timing.timer.enabled:
+            print(timing.timer.report())
         if self._buttonFlag:
             sc.close_sensel(self.handle, self.frame)
         sys.exit()
@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+
+"""Output stages of the marker pipeline
+
+    An output is called once per frame with the tracked markers:
+    output.send(markers, blobs, timestamp)
+
+    markers are forcestamp.marker objects or rows of a marker record array
+    (markerRecords), which have the same field attributes. AsyncSink passes
+    record snapshots to its outputs on a background thread, so the detection
+    loop does not wait for the network.
+"""
+
+import collections
+import json
+import threading
+import time
+
+import numpy as np
+from oscpy.client import OSCClient
+
+import circular
+
+# marker fields sent as OSC lists, in message order: (address, marker attribute)
+OSC_FIELDS = [
+    (b'/pos_x', 'pos_x'),
+    (b'/pos_y', 'pos_y'),
+    (b'/force', 'force'),
+    (b'/cof_x', 'cof_x'),
+    (b'/cof_y', 'cof_y'),
+    (b'/angle', 'rot'),
+    (b'/angle_unwrapped', 'rot_unwrapped'),
+    (b'/angular_velocity', 'v_rot'),
+    (b'/radius', 'radius'),
+]
+
+# marker state snapshot of a frame
+MARKER_DTYPE = np.dtype([
+    ('ID', '<i4'),
+    ('pos_x', '<f8'), ('pos_y', '<f8'),
+    ('force', '<f8'),
+    ('cof_x', '<f8'), ('cof_y', '<f8'),
+    ('rot', '<f8'), ('rot_unwrapped', '<f8'), ('v_rot', '<f8'),
+    ('radius', '<f8'),
+    ('d_pos_x', '<f8'), ('d_pos_y', '<f8'),
+    ('d_force', '<f8'),
+    ('d_cof_x', '<f8'), ('d_cof_y', '<f8'),
+    ('d_rot', '<f8'),
+])
+
+# blob snapshot of a frame
+BLOB_DTYPE = np.dtype([
+    ('ID', '<i4'),
+    ('cx', '<f8'), ('cy', '<f8'),
+    ('force', '<f8'),
+])
+
+
+def markerRecords(markers):
+    # copy of the marker fields as a record array, rows have the fields as attributes
+    if isinstance(markers, np.ndarray):
+        return markers.astype(MARKER_DTYPE).view(np.recarray)
+    records = np.recarray(len(markers), dtype=MARKER_DTYPE)
+    for i, mkr in enumerate(markers):
+        records[i] = tuple(getattr(mkr, name) for name in MARKER_DTYPE.names)
+    return records
+
+
+def blobRecords(blobs):
+    records = np.recarray(len(blobs), dtype=BLOB_DTYPE)
+    for i, b in enumerate(blobs):
+        records[i] = (b.ID, b.cx, b.cy, b.force)
+    return records
+
+
+# output ranges of the scaled marker parameters, columns of an IDparam array
+PARAM_NAMES = ['posx_max', 'posx_min', 'posy_max', 'posy_min', 'force_max',
+               'force_min', 'cof_x_max', 'cof_x_min', 'cof_y_max', 'cof_y_min']
+
+
+def IDParameters(numID):
+    # (numID, 10) array of the default output ranges of each marker ID
+    IDparam = np.empty((numID, len(PARAM_NAMES)))
+    IDparam[:] = [100.0, 0.0, 100.0, 0.0, 100.0, 0.0, 100.0, -100.0, 100.0, -100.0]
+    return IDparam
+
+
+def scaleParameters(values, IDs, IDparam, inputRanges):
+    """Scale marker parameters from their input ranges to the output ranges of their IDs
+
+    Args
+    ----
+    values (array:float): (numMarkers, 5) pos_x, pos_y, force, cof_x, cof_y of each marker
+    IDs (array:int): (numMarkers,) marker IDs, rows of IDparam
+    IDparam (array:float): (numID, 10) output ranges, columns in PARAM_NAMES order
+    inputRanges (array:float): (5, 2) (min, max) input range of each parameter.
+        values are clipped to these ranges
+
+    Returns
+    -------
+    scaled (array:float): (numMarkers, 5) scaled parameters
+    """
+    inputRanges = np.asarray(inputRanges, dtype=float)
+    low = inputRanges[:, 0]
+    high = inputRanges[:, 1]
+    ranges = IDparam[np.asarray(IDs, dtype=int)]
+    outMax = ranges[:, 0::2]
+    outMin = ranges[:, 1::2]
+    t = (np.clip(values, low, high) - low) / (high - low)
+    return (outMax - outMin) * t + outMin
+
+
+def frameJSON(markers, timestamp, frame):
+    # JSON text of the markers of a frame
+    records = markers if isinstance(markers, np.ndarray) else markerRecords(markers)
+    return json.dumps({
+        'frame': frame,
+        'timestamp': float(timestamp),
+        'markers': [dict(zip(MARKER_DTYPE.names, row)) for row in records.tolist()],
+    })
+
+
+class OSCOutput:
+    # sends the marker fields as OSC lists, one list per field,
+    # with the addresses of ForceStamp.sendMarkerParameters
+    # address, port: OSC receiver
+    # bundle: pack the messages of a frame into one OSC bundle (one datagram),
+    #     time tagged with the frame timestamp and led by a /frame counter message.
+    #     otherwise every field is a separate datagram
+    # maxMarkers: initial capacity of the field buffers, grown when exceeded
+
+    def __init__(self, address='127.0.0.1', port=12000, bundle=True, maxMarkers=16):
+        self.address = address
+        self.port = port
+        self.bundle = bundle
+        self.osc = OSCClient(address, port)
+
+        self.numFrames = 0
+        self.allocate(maxMarkers)
+
+    def allocate(self, maxMarkers):
+        # field values of the markers of a frame, one row per field
+        self.maxMarkers = maxMarkers
+        self.values = np.zeros((len(OSC_FIELDS), maxMarkers))
+        self.IDs = np.zeros(maxMarkers, dtype=np.int64)
+
+    def fill(self, markers):
+        # copy the marker fields into the buffers
+        if len(markers) > self.maxMarkers:
+            self.allocate(max(len(markers), 2 * self.maxMarkers))
+        for i, mkr in enumerate(markers):
+            column = self.values[:, i]
+            for j, (address, name) in enumerate(OSC_FIELDS):
+                column[j] = getattr(mkr, name)
+            self.IDs[i] = mkr.ID
+
+    def messages(self, numMarkers):
+        # (address, values) of the fields of the first numMarkers markers
+        messages = [(b'/num', [numMarkers])]
+        values = self.values[:, :numMarkers].tolist()
+        for (address, name), row in zip(OSC_FIELDS, values):
+            messages.append((address, row))
+        messages.append((b'/id', self.IDs[:numMarkers].tolist()))
+        return messages
+
+    def send(self, markers, blobs=None, timestamp=None):
+        self.fill(markers)
+        messages = self.messages(len(markers))
+        if self.bundle:
+            timestamp = time.time() if timestamp is None else timestamp
+            messages.insert(0, (b'/frame', [self.numFrames]))
+            self.osc.send_bundle(messages, timetag=timestamp)
+        else:
+            for address, values in messages:
+                self.osc.send_message(address, values)
+        self.numFrames += 1
+
+    def close(self):
+        pass
+
+
+# field groups of the delta stream: (name, columns of OSC_FIELDS)
+DELTA_GROUPS = [
+    ('pos', [0, 1]),
+    ('force', [2]),
+    ('cof', [3, 4]),
+    ('angle', [5, 6, 7]),
+]
+
+
+class DeltaOSCOutput(OSCOutput):
+    # sends only the fields which changed since they were last sent, per marker ID:
+    #     /m{ID}/appear [pos_x, pos_y, radius] when a marker ID appears
+    #     /m{ID}/disappear [] when it is gone
+    #     /m{ID}/pos [pos_x, pos_y], /m{ID}/force [force], /m{ID}/cof [cof_x, cof_y],
+    #     /m{ID}/angle [angle, angle_unwrapped, angular_velocity] when they changed
+    # every keyframeInterval frames, all fields of all markers are sent with /keyframe [frame].
+    # the messages of a frame go in one bundle after /frame [frame]; frames without changes are not sent.
+    # epsilons: smallest change which is sent, per group (angles in radians)
+    # markers whose ID is not recognized yet (ID 0) are left out, there is no ID to key their state by.
+    # a marker appears once its ID is recognized
+
+    def __init__(self, address='127.0.0.1', port=12000, keyframeInterval=100,
+                 epsilons=None, maxMarkers=16, maxID=128):
+        OSCOutput.__init__(self, address, port, bundle=True, maxMarkers=maxMarkers)
+        self.keyframeInterval = keyframeInterval
+        self.epsilons = {'pos': 0.1, 'force': 10.0, 'cof': 0.1, 'angle': 0.01}
+        if epsilons is not None:
+            self.epsilons.update(epsilons)
+
+        # last sent fields of each marker ID, nan when never sent
+        self.sent = np.full((maxID, len(OSC_FIELDS)), np.nan)
+        self.present = np.zeros(maxID, dtype=bool)
+        self.addresses = {}
+        self.numSent = 0
+
+    def fieldAddress(self, ID, name):
+        # cached OSC address of a marker field
+        key = (ID, name)
+        if key not in self.addresses:
+            self.addresses[key] = ('/m%d/%s' % (ID, name)).encode()
+        return self.addresses[key]
+
+    def changes(self, IDs, values, keyframe):
+        # (ID, group name, columns) of the fields to send
+        # values: (numMarkers, numFields) current fields
+        changes = []
+        previous = self.sent[IDs]
+        for name, columns in DELTA_GROUPS:
+            if keyframe:
+                changed = np.ones(len(IDs), dtype=bool)
+            else:
+                if name == 'angle':
+                    delta = np.abs(np.column_stack((
+                        circular.angleDifference(values[:, 5], previous[:, 5]),
+                        values[:, 6:8] - previous[:, 6:8])))
+                else:
+                    delta = np.abs(values[:, columns] - previous[:, columns])
+                # never sent fields (nan) always count as changed
+                changed = ~np.all(delta <= self.epsilons[name], axis=1)
+            for i in np.flatnonzero(changed):
+                changes.append((IDs[i], name, columns))
+        return changes
+
+    def send(self, markers, blobs=None, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        keyframe = self.numFrames % self.keyframeInterval == 0
+
+        self.fill(markers)
+        recognized = np.flatnonzero(self.IDs[:len(markers)] > 0)
+        IDs = self.IDs[recognized]
+        values = self.values[:, recognized].T
+        if len(IDs) > 0 and IDs.max() >= len(self.sent):
+            size = max(IDs.max() + 1, 2 * len(self.sent))
+            self.sent = np.vstack((self.sent, np.full((size - len(self.sent), len(OSC_FIELDS)), np.nan)))
+            self.present = np.concatenate((self.present, np.zeros(size - len(self.present), dtype=bool)))
+
+        messages = [(b'/frame', [self.numFrames])]
+        if keyframe:
+            messages.append((b'/keyframe', [self.numFrames]))
+
+        # appear and disappear events
+        current = np.zeros(len(self.present), dtype=bool)
+        current[IDs] = True
+        for ID in np.flatnonzero(current & ~self.present):
+            i = np.flatnonzero(IDs == ID)[-1]
+            messages.append((self.fieldAddress(ID, 'appear'), [values[i, 0], values[i, 1], values[i, 8]]))
+        for ID in np.flatnonzero(self.present & ~current):
+            messages.append((self.fieldAddress(ID, 'disappear'), []))
+            self.sent[ID] = np.nan
+        self.present = current
+
+        for ID, name, columns in self.changes(IDs, values, keyframe):
+            i = np.flatnonzero(IDs == ID)[-1]
+            messages.append((self.fieldAddress(ID, name), values[i, columns].tolist()))
+            self.sent[ID, columns] = values[i, columns]
+
+        if len(messages) > 1:
+            self.osc.send_bundle(messages, timetag=timestamp)
+            self.numSent += 1
+        self.numFrames += 1
+
+
+class WebSocketOutput:
+    # serves the markers of every frame as JSON text (frameJSON) to all
+    # connected WebSocket clients. needs the websockets package
+    # host, port: address the server listens on
+
+    def __init__(self, host='0.0.0.0', port=8765):
+        try:
+            import asyncio
+            import websockets
+        except ImportError:
+            raise ImportError('WebSocketOutput needs the websockets package (pip install websockets)')
+        self.asyncio = asyncio
+        self.websockets = websockets
+        self.host = host
+        self.port = port
+        self.clients = set()
+        self.numFrames = 0
+
+        # the server runs on its own event loop thread
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+        self.thread = threading.Thread(target=self.serve, args=(started,), daemon=True)
+        self.error = None
+        self.thread.start()
+        started.wait()
+        if self.error is not None:
+            raise self.error
+
+    def serve(self, started):
+        asyncio = self.asyncio
+        asyncio.set_event_loop(self.loop)
+
+        async def handler(websocket, *args):
+            self.clients.add(websocket)
+            try:
+                await websocket.wait_closed()
+            finally:
+                self.clients.discard(websocket)
+
+        async def start():
+            return await self.websockets.serve(handler, self.host, self.port)
+
+        try:
+            self.server = self.loop.run_until_complete(start())
+        except Exception as e:
+            self.error = e
+            return
+        finally:
+            started.set()
+        self.loop.run_forever()
+
+    def broadcast(self, message):
+        self.websockets.broadcast(self.clients, message)
+
+    def send(self, markers, blobs=None, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        if len(self.clients) > 0:
+            self.loop.call_soon_threadsafe(self.broadcast, frameJSON(markers, timestamp, self.numFrames))
+        self.numFrames += 1
+
+    def close(self):
+        if self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.server.close)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(1)
+
+
+class AsyncSink:
+    # sends frames to outputs on a background thread
+    # outputs: objects with send(markers, blobs, timestamp), e.g. OSCOutput
+    # maxQueue: frames waiting to be sent. when full, the oldest frame is dropped
+    # lateThreshold: frames sent later than this after they were queued (s) count as late.
+    #     measured from the queue time, frame timestamps may be recorded times of a replay
+    #
+    # send() only copies the markers and blobs into record arrays and never blocks on I/O.
+    # counters: numQueued, dropped, late, errors (exceptions raised by an output)
+
+    def __init__(self, outputs, maxQueue=8, lateThreshold=0.02):
+        self.outputs = list(outputs)
+        self.maxQueue = maxQueue
+        self.lateThreshold = lateThreshold
+
+        self.queue = collections.deque()
+        self.condition = threading.Condition()
+        self.running = True
+
+        self.numQueued = 0
+        self.numSent = 0
+        self.dropped = 0
+        self.late = 0
+        self.errors = 0
+        self.lastError = None
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def send(self, markers, blobs=(), timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        item = (markerRecords(markers), blobRecords(blobs if blobs is not None else ()), timestamp, time.time())
+        with self.condition:
+            if len(self.queue) >= self.maxQueue:
+                # drop the oldest frame, consumers want the latest state
+                self.queue.popleft()
+                self.dropped += 1
+            self.queue.append(item)
+            self.numQueued += 1
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and len(self.queue) == 0:
+                    self.condition.wait()
+                if len(self.queue) == 0:
+                    return
+                markers, blobs, timestamp, t_queued = self.queue.popleft()
+
+            if time.time() - t_queued > self.lateThreshold:
+                self.late += 1
+            for out in self.outputs:
+                try:
+                    out.send(markers, blobs, timestamp)
+                except Exception as e:
+                    # an unreachable receiver must not stop the other outputs
+                    self.errors += 1
+                    self.lastError = e
+            self.numSent += 1
+
+    def stats(self):
+        return {'queued': self.numQueued, 'sent': self.numSent, 'dropped': self.dropped,
+                'late': self.late, 'errors': self.errors}
+
+    def close(self):
+        # send the queued frames, then stop the thread and close the outputs
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+        for out in self.outputs:
+            out.close()
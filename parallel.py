@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+"""Pipeline with blob detection in worker processes
+
+    Blob detection (detectBlobs: threshold, findLocalPeaks, subpixel peaks and
+    blob forces) only depends on the frame, so frames are detected in a pool of
+    worker processes. Frames are handed to the workers through slots of a
+    shared memory block, and the blobs come back as small tables. The results
+    are taken in frame order and passed to TrackBlobs.track and
+    TrackMarkers.update in the main process, so the tracking matches the
+    serial pipeline.Pipeline frame by frame.
+
+    With timing enabled, the workers return the durations of the detectBlobs
+    spans with each blob table, and they are recorded with the frame they
+    belong to, as is the acquisition of frames read ahead. detectBlobs.wait is
+    the time the main process waits for a frame's blobs.
+
+    Usage
+    -----
+    pipeline = ParallelPipeline(recording.FrameReplay('session.fsr', realtime=False), workers=4)
+    pipeline.run()
+    pipeline.close()
+
+    python pipeline.py --replay session.fsr --no-realtime --workers 4
+"""
+
+from __future__ import print_function
+
+import collections
+import os
+import signal
+import time
+
+import numpy as np
+import multiprocessing
+from multiprocessing import shared_memory
+
+import forcestamp
+import pipeline
+import timing
+
+# blobs of a frame as returned by the workers
+BLOB_TABLE_DTYPE = np.dtype([
+    ('cx', '<i8'),
+    ('cy', '<i8'),
+    ('area', '<f8'),
+    ('force', '<f8'),
+])
+
+
+def blobTable(blobs):
+    # structured array of the detected blobs
+    table = np.zeros(len(blobs), dtype=BLOB_TABLE_DTYPE)
+    for row, b in zip(table, blobs):
+        row['cx'] = b.cx
+        row['cy'] = b.cy
+        row['area'] = b.area
+        row['force'] = b.force
+    return table
+
+
+def tableBlobs(table):
+    # Blob objects of a blob table, not yet tracked
+    return [forcestamp.Blob(row['cx'], row['cy'], row['area'], row['force'], [], []) for row in table]
+
+
+class FrameSlots:
+    # numSlots frames of the same shape in a shared memory block
+    # name: segment name. a new segment is created if None
+
+    def __init__(self, numSlots, shape, dtype=np.float, name=None):
+        self.numSlots = numSlots
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        size = numSlots * int(np.prod(shape)) * self.dtype.itemsize
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            # workers share the resource tracker of the creating process,
+            # which unlinks the segment once when it is closed
+            self.shm = shared_memory.SharedMemory(name)
+        self.name = self.shm.name
+        self.frames = np.ndarray((numSlots,) + self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    def close(self):
+        if self.shm is None:
+            return
+        del self.frames
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+        self.shm = None
+
+
+# state of a worker process
+_worker = {}
+
+
+def initWorker(name, numSlots, shape, dtype, timed=False):
+    # ctrl-c is handled by the main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    timing.timer.reset()
+    if timed:
+        timing.timer.enable()
+    else:
+        timing.timer.disable()
+    slots = FrameSlots(numSlots, shape, dtype, name=name)
+    _worker['slots'] = slots
+    _worker['buffers'] = forcestamp.BlobBuffers(slots.shape, slots.dtype)
+
+
+def detectSlot(slot, areaThreshold, forceThreshold, binThreshold):
+    # blob table of the frame in a slot, with the span durations of the
+    # detection ({name: seconds}, None when timing is off)
+    blobs = forcestamp.detectBlobs(_worker['slots'].frames[slot],
+                                   areaThreshold=areaThreshold,
+                                   forceThreshold=forceThreshold,
+                                   binThreshold=binThreshold,
+                                   buffers=_worker['buffers'])[0]
+    durations = None
+    if timing.timer.enabled:
+        durations = timing.timer.frameDurations()
+        timing.timer.endFrame()
+    return blobTable(blobs), durations
+
+
+class ParallelPipeline(pipeline.Pipeline):
+    # pipeline.Pipeline detecting blobs in worker processes
+    # workers: number of worker processes, the number of cores if None
+    # slots: frames in flight, twice the workers if None. frames are read ahead
+    #     of the tracking by up to this many frames
+    # other arguments as pipeline.Pipeline
+
+    def __init__(self, source, outputs=(), workers=None, slots=None, **kwargs):
+        pipeline.Pipeline.__init__(self, source, outputs, **kwargs)
+        self.numWorkers = workers or os.cpu_count() or 1
+        self.numSlots = slots or 2 * self.numWorkers
+
+        # started with the first frame, once its shape is known
+        self.slots = None
+        self.pool = None
+        self.freeSlots = collections.deque(range(self.numSlots))
+        # (slot, frame, timestamp, acquisition duration, result) in frame order
+        self.pending = collections.deque()
+        self.exhausted = False
+
+    def start(self, shape, dtype):
+        self.slots = FrameSlots(self.numSlots, shape, dtype)
+        self.pool = multiprocessing.Pool(self.numWorkers, initializer=initWorker,
+                                         initargs=(self.slots.name, self.numSlots, self.slots.shape,
+                                                   self.slots.dtype.str, timing.timer.enabled))
+
+    def submit(self):
+        # read the next frame into a free slot and hand it to the workers.
+        # the frame is read ahead, its acquisition is recorded once it is processed
+        t_start = time.perf_counter()
+        f_image = self.source.scan_frames()
+        acquisition = time.perf_counter() - t_start
+        timestamp = self.frameTimestamp()
+        if self.pool is None:
+            self.start(f_image.shape, f_image.dtype)
+        slot = self.freeSlots.popleft()
+        self.slots.frames[slot] = f_image
+        result = self.pool.apply_async(detectSlot, (slot,
+                                                    self.BlobTracker.areaThreshold,
+                                                    self.BlobTracker.forceThreshold,
+                                                    self.BlobTracker.binThreshold))
+        self.pending.append((slot, f_image, timestamp, acquisition, result))
+
+    def step(self):
+        # process the oldest frame in flight. raises EOFError once the source
+        # ended and every frame is processed
+        while self.freeSlots and not self.exhausted:
+            try:
+                self.submit()
+            except EOFError:
+                self.exhausted = True
+        if not self.pending:
+            raise EOFError('end of source')
+
+        slot, f_image, timestamp, acquisition, result = self.pending.popleft()
+        with timing.timer.span('detectBlobs.wait'):
+            table, durations = result.get()
+        self.freeSlots.append(slot)
+        if timing.timer.enabled:
+            timing.timer.add({'acquisition': acquisition})
+            timing.timer.add(durations or {})
+
+        with timing.timer.span('TrackBlobs.update'):
+            blobs = self.BlobTracker.track(tableBlobs(table), timestamp)
+        return self.process(f_image, blobs, timestamp)
+
+    def close(self):
+        if self.pool is not None:
+            # frames still in flight are dropped
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        self.pending.clear()
+        if self.slots is not None:
+            self.slots.close()
+            self.slots = None
+        pipeline.Pipeline.close(self)
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+"""Headless marker pipeline: acquisition, blob and marker tracking, output
+
+    Runs without Qt, for nodes without a display.
+
+    Usage
+    -----
+    python pipeline.py                            # Morph, OSC to 127.0.0.1:12000
+    python pipeline.py --replay session.fsr --no-realtime --timing
+    python pipeline.py --radii 22 13.6 20 12.8 --distance-tolerance 1.5
+    python pipeline.py --replay session.fsr --no-realtime --workers 4
+"""
+
+from __future__ import print_function
+
+import argparse
+import sys
+import time
+
+import forcestamp
+import timing
+
+# marker radii of the GUI
+RADII = [55 / 2 / 1.25, 17 / 1.25, 20.0, 16 / 1.25]
+
+
+class MorphSource:
+    # frame source of the first connected Morph
+
+    def __init__(self, setrate=2000, recorder=None):
+        import sensel_control as sc
+        self.sc = sc
+        self.recorder = recorder
+        self.handle, self.info = sc.open_sensel()
+        self.frame = sc.init_frame(self.handle, setrate=setrate, baseline=0)
+
+    def scan_frames(self):
+        return self.sc.scan_frames(self.handle, self.frame, self.info, recorder=self.recorder)
+
+    def close(self):
+        self.sc.close_sensel(self.handle, self.frame)
+
+
+class Pipeline:
+    # source: object with scan_frames() returning a force frame
+    #     (MorphSource, recording.FrameReplay)
+    # outputs: objects with send(markers, blobs, timestamp), e.g. output.OSCOutput
+    # radii, distanceTolerance: settings of TrackMarkers
+    # areaThreshold, forceThreshold, binThreshold: settings of detectBlobs
+
+    def __init__(self, source, outputs=(), radii=RADII, distanceTolerance=1,
+                 areaThreshold=1000, forceThreshold=6, binThreshold=2):
+        self.source = source
+        self.outputs = list(outputs)
+
+        self.BlobTracker = forcestamp.TrackBlobs(areaThreshold=areaThreshold,
+                                                 forceThreshold=forceThreshold,
+                                                 binThreshold=binThreshold)
+        self.MarkerTracker = forcestamp.TrackMarkers(radii, distanceTolerance=distanceTolerance)
+
+        self.f_image = None
+        self.blobs = []
+        self.markers = []
+        self.numFrames = 0
+
+    def acquire(self):
+        # next frame of the source and its timestamp. raises EOFError at the end of a replay
+        with timing.timer.span('acquisition'):
+            f_image = self.source.scan_frames()
+        return f_image, self.frameTimestamp()
+
+    def frameTimestamp(self):
+        # replayed frames keep their recorded time, so a replay tracks the same at any speed
+        timestamp = getattr(self.source, 'timestamp', None)
+        if timestamp is None:
+            timestamp = time.time()
+        return float(timestamp)
+
+    def step(self):
+        # process one frame. raises EOFError at the end of a replay
+        f_image, timestamp = self.acquire()
+        blobs = self.BlobTracker.update(f_image, timestamp)
+        return self.process(f_image, blobs, timestamp)
+
+    def process(self, f_image, blobs, timestamp):
+        # marker tracking and outputs of a frame with its tracked blobs
+        self.f_image = f_image
+        self.blobs = blobs
+        self.MarkerTracker.update(f_image, blobs, timestamp)
+        self.markers = self.MarkerTracker.markers
+
+        with timing.timer.span('output'):
+            for out in self.outputs:
+                out.send(self.markers, self.blobs, timestamp)
+
+        self.numFrames += 1
+        timing.timer.endFrame()
+        return self.markers
+
+    def run(self, maxFrames=None, seconds=None):
+        # process frames until the source ends, the limits are reached or ctrl-c
+        t_start = time.time()
+        try:
+            while maxFrames is None or self.numFrames < maxFrames:
+                if seconds is not None and time.time() - t_start > seconds:
+                    break
+                self.step()
+        except (EOFError, KeyboardInterrupt):
+            pass
+        return self.numFrames
+
+    def close(self):
+        for out in self.outputs:
+            out.close()
+        if hasattr(self.source, 'close'):
+            self.source.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Track ForceStamp markers without a GUI')
+    parser.add_argument('--replay', help='replay a recording instead of the Morph')
+    parser.add_argument('--no-realtime', dest='realtime', action='store_false',
+                        help='replay frames as fast as possible')
+    parser.add_argument('--loop', action='store_true', help='loop the replay')
+    parser.add_argument('--rate', type=int, default=2000, help='max frame rate of the Morph')
+    parser.add_argument('--radii', type=float, nargs='+', default=RADII, help='marker radii')
+    parser.add_argument('--distance-tolerance', type=float, default=1)
+    parser.add_argument('--area-threshold', type=float, default=1000)
+    parser.add_argument('--force-threshold', type=float, default=6)
+    parser.add_argument('--bin-threshold', type=float, default=2)
+    parser.add_argument('--osc-address', default='127.0.0.1')
+    parser.add_argument('--osc-port', type=int, default=12000)
+    parser.add_argument('--no-osc', dest='osc', action='store_false', help='do not send OSC')
+    parser.add_argument('--no-bundle', dest='bundle', action='store_false',
+                        help='send every OSC field as a separate message instead of one bundle per frame')
+    parser.add_argument('--delta', action='store_true',
+                        help='send only changed marker fields, with appear/disappear events and keyframes')
+    parser.add_argument('--keyframe-interval', type=int, default=100, help='frames between delta keyframes')
+    parser.add_argument('--websocket', type=int, default=None, metavar='PORT',
+                        help='serve the markers as JSON to WebSocket clients on this port')
+    parser.add_argument('--shm', default=None, metavar='NAME',
+                        help='publish the marker state in a shared memory segment for local consumers')
+    parser.add_argument('--sync', action='store_true',
+                        help='send outputs on the detection loop instead of a background thread')
+    parser.add_argument('--queue', type=int, default=8, help='frames queued for the output thread')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='detect blobs in this many worker processes (0: in the tracking process)')
+    parser.add_argument('--slots', type=int, default=None,
+                        help='frames in flight to the workers (default: twice the workers)')
+    parser.add_argument('--frames', type=int, default=None, help='stop after this many frames')
+    parser.add_argument('--seconds', type=float, default=None, help='stop after this time')
+    parser.add_argument('--timing', action='store_true', help='print per-stage timing at exit')
+    args = parser.parse_args(argv)
+
+    if args.timing:
+        timing.timer.enable()
+
+    if args.replay:
+        import recording
+        source = recording.FrameReplay(args.replay, realtime=args.realtime, loop=args.loop)
+    else:
+        source = MorphSource(setrate=args.rate)
+
+    import output
+    outputs = []
+    if args.osc:
+        if args.delta:
+            outputs.append(output.DeltaOSCOutput(args.osc_address, args.osc_port,
+                                                 keyframeInterval=args.keyframe_interval))
+        else:
+            outputs.append(output.OSCOutput(args.osc_address, args.osc_port, bundle=args.bundle))
+    if args.websocket is not None:
+        outputs.append(output.WebSocketOutput(port=args.websocket))
+    sink = None
+    if outputs and not args.sync:
+        # network I/O on a background thread, the detection loop never waits for it
+        sink = output.AsyncSink(outputs, maxQueue=args.queue)
+        outputs = [sink]
+    if args.shm:
+        # a memory write, cheap enough for the detection loop
+        import shared_state
+        outputs.append(shared_state.SharedStatePublisher(args.shm))
+
+    settings = dict(radii=args.radii,
+                    distanceTolerance=args.distance_tolerance,
+                    areaThreshold=args.area_threshold,
+                    forceThreshold=args.force_threshold,
+                    binThreshold=args.bin_threshold)
+    if args.workers > 0:
+        import parallel
+        pipeline = parallel.ParallelPipeline(source, outputs, workers=args.workers, slots=args.slots, **settings)
+    else:
+        pipeline = Pipeline(source, outputs, **settings)
+    t_start = time.time()
+    try:
+        numFrames = pipeline.run(args.frames, args.seconds)
+    finally:
+        pipeline.close()
+    duration = time.time() - t_start
+    print('%d frames in %.1f s (%.1f fps)' % (numFrames, duration, numFrames / duration if duration > 0 else 0))
+    if sink is not None:
+        print('output: %(sent)d sent, %(dropped)d dropped, %(late)d late, %(errors)d errors' % sink.stats())
+    if args.timing:
+        print(timing.timer.report())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+
+"""Recording and replay of raw Morph force frames
+
+    File layout
+    -----------
+    header (64 bytes): magic, version, rows, cols, flags
+    records: timestamp (float64), lost frame count (int32),
+        force frame (float32, rows x cols)
+
+    Uncompressed files store the records back to back after the header.
+    Compressed files store chunks of records, each as
+    (number of frames (uint32), payload size (uint32), zlib payload).
+    Files are append-only: a recorder reopening an existing file with the
+    same frame size keeps writing at its end.
+    Uncompressed files can be memory-mapped (MappedRecording) for random
+    access to any frame without reading the file.
+
+    Usage
+    -----
+    python recording.py record session.fsr --seconds 60
+    python recording.py info session.fsr
+    python recording.py decompress session.fsr session_raw.fsr
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import struct
+import sys
+import time
+import zlib
+
+import numpy as np
+
+MAGIC = b'FSTAMPRC'
+VERSION = 1
+HEADER_SIZE = 64
+FLAG_COMPRESSED = 0x01
+
+_header = struct.Struct('<8sIIII')
+_chunkHeader = struct.Struct('<II')
+
+
+def recordDtype(rows, cols):
+    # numpy dtype of one frame record
+    return np.dtype([('timestamp', '<f8'),
+                     ('lost', '<i4'),
+                     ('frame', '<f4', (rows, cols))])
+
+
+def writeHeader(f, rows, cols, flags):
+    header = _header.pack(MAGIC, VERSION, rows, cols, flags)
+    f.write(header + b'\x00' * (HEADER_SIZE - len(header)))
+
+
+def readHeader(f):
+    # returns (rows, cols, flags) of an opened recording
+    data = f.read(HEADER_SIZE)
+    if len(data) < HEADER_SIZE:
+        raise ValueError('not a ForceStamp recording: file too short')
+    magic, version, rows, cols, flags = _header.unpack(data[:_header.size])
+    if magic != MAGIC:
+        raise ValueError('not a ForceStamp recording: bad magic %r' % magic)
+    if version != VERSION:
+        raise ValueError('unsupported recording version %d' % version)
+    return rows, cols, flags
+
+
+class SensorInfo:
+    # frame size of a recording, with the fields of sensel.SenselSensorInfo used here
+
+    def __init__(self, num_rows, num_cols):
+        self.num_rows = num_rows
+        self.num_cols = num_cols
+
+
+class FrameRecorder:
+    # rows, cols: frame size (info.num_rows, info.num_cols of the Morph)
+    # compress: zlib compress each chunk
+    # chunkFrames: number of frames buffered before a write
+    # level: zlib compression level
+
+    def __init__(self, path, rows=105, cols=185, compress=False, chunkFrames=64, level=1):
+        self.path = path
+        self.rows = rows
+        self.cols = cols
+        self.compress = compress
+        self.level = level
+        self.flags = FLAG_COMPRESSED if compress else 0
+
+        self.dtype = recordDtype(rows, cols)
+        self.buffer = np.zeros(chunkFrames, dtype=self.dtype)
+        self.numBuffered = 0
+        self.numFrames = 0
+
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            # append to an existing recording
+            with open(path, 'rb') as f:
+                header = readHeader(f)
+            if header != (rows, cols, self.flags):
+                raise ValueError('%s was recorded with a different frame size or compression' % path)
+            self.f = open(path, 'ab')
+        else:
+            self.f = open(path, 'wb')
+            writeHeader(self.f, rows, cols, self.flags)
+
+    def write(self, f_image, timestamp=None, lost=0):
+        # add a frame. timestamp defaults to the current time
+        record = self.buffer[self.numBuffered]
+        record['timestamp'] = time.time() if timestamp is None else timestamp
+        record['lost'] = lost
+        record['frame'] = f_image
+        self.numBuffered += 1
+        self.numFrames += 1
+        if self.numBuffered == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        # write buffered frames as one chunk
+        if self.numBuffered == 0:
+            return
+        chunk = self.buffer[:self.numBuffered]
+        if self.compress:
+            payload = zlib.compress(chunk.tobytes(), self.level)
+            self.f.write(_chunkHeader.pack(self.numBuffered, len(payload)))
+            self.f.write(payload)
+        else:
+            self.f.write(chunk.data)
+        self.f.flush()
+        self.numBuffered = 0
+
+    def close(self):
+        if not self.f.closed:
+            self.flush()
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def readChunks(path):
+    # yields record arrays of a recording chunk by chunk
+    with open(path, 'rb') as f:
+        rows, cols, flags = readHeader(f)
+        dtype = recordDtype(rows, cols)
+        if flags & FLAG_COMPRESSED:
+            while True:
+                data = f.read(_chunkHeader.size)
+                if len(data) < _chunkHeader.size:
+                    break
+                numFrames, size = _chunkHeader.unpack(data)
+                payload = f.read(size)
+                if len(payload) < size:
+                    break  # truncated chunk at the end of an interrupted recording
+                yield np.frombuffer(zlib.decompress(payload), dtype=dtype, count=numFrames)
+        else:
+            chunkFrames = 64
+            while True:
+                data = f.read(dtype.itemsize * chunkFrames)
+                count = len(data) // dtype.itemsize
+                if count == 0:
+                    break
+                yield np.frombuffer(data, dtype=dtype, count=count)
+
+
+class MappedRecording:
+    # memory-mapped uncompressed recording
+    # frames: (n_frames, rows, cols) float32 array backed by the file
+    # timestamps, lost: (n_frames,) arrays
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            rows, cols, flags = readHeader(f)
+        if flags & FLAG_COMPRESSED:
+            raise ValueError('%s is compressed and cannot be memory-mapped, '
+                             'convert it with recording.decompress' % path)
+        self.info = SensorInfo(rows, cols)
+
+        dtype = recordDtype(rows, cols)
+        # ignore a partial record at the end of an interrupted recording
+        numFrames = (os.path.getsize(path) - HEADER_SIZE) // dtype.itemsize
+        if numFrames > 0:
+            self.records = np.memmap(path, dtype=dtype, mode='r',
+                                     offset=HEADER_SIZE, shape=(numFrames,))
+        else:
+            self.records = np.zeros(0, dtype=dtype)
+
+        self.frames = self.records['frame']
+        self.timestamps = self.records['timestamp']
+        self.lost = self.records['lost']
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, index):
+        return self.frames[index]
+
+    def frameAt(self, timestamp):
+        # index of the last frame recorded at or before timestamp
+        index = np.searchsorted(self.timestamps, timestamp, side='right') - 1
+        return max(int(index), 0)
+
+
+def decompress(src, dst):
+    # convert a compressed recording to a memory-mappable one
+    with open(src, 'rb') as f:
+        rows, cols, flags = readHeader(f)
+    with open(dst, 'wb') as f:
+        writeHeader(f, rows, cols, 0)
+        for chunk in readChunks(src):
+            f.write(chunk.data)
+
+
+class FrameReplay:
+    # frame source replaying a recording, in place of a Morph
+    # realtime: pace frames by their recorded timestamps, otherwise as fast as possible
+    # loop: restart at the end instead of raising EOFError
+    # start: index of the first frame
+
+    def __init__(self, path, realtime=True, loop=False, start=0):
+        self.path = path
+        self.realtime = realtime
+        self.loop = loop
+
+        with open(path, 'rb') as f:
+            rows, cols, flags = readHeader(f)
+        self.info = SensorInfo(rows, cols)
+
+        # uncompressed recordings are read through a memory map
+        self.mapped = None if flags & FLAG_COMPRESSED else MappedRecording(path)
+
+        self.lost = 0
+        self.timestamp = 0
+        self.numFrames = 0
+        self.seek(start)
+
+    def restart(self):
+        self.seek(0)
+
+    def seek(self, index):
+        # continue the replay at a frame index
+        self.chunks = None if self.mapped is not None else readChunks(self.path)
+        self.chunk = self.mapped.records if self.mapped is not None else None
+        self.index = index
+        self.t_start = None
+
+        if self.mapped is None:
+            # skip whole chunks of compressed recordings
+            for chunk in self.chunks:
+                if self.index < len(chunk):
+                    self.chunk = chunk
+                    break
+                self.index -= len(chunk)
+
+    def next(self):
+        # next record of the recording
+        while self.chunk is None or self.index >= len(self.chunk):
+            if self.mapped is not None:
+                chunk = None
+            else:
+                chunk = next(self.chunks, None)
+            if chunk is None:
+                if not self.loop or self.numFrames == 0:
+                    raise EOFError('end of recording %s' % self.path)
+                self.restart()
+            else:
+                self.chunk = chunk
+                self.index = 0
+        record = self.chunk[self.index]
+        self.index += 1
+        return record
+
+    def scan_frames(self, handle=None, frame=None, info=None):
+        # same interface as sensel_control.scan_frames. returns the next force frame
+        record = self.next()
+        self.numFrames += 1
+        self.timestamp = record['timestamp']
+        self.lost = record['lost']
+
+        if self.realtime:
+            now = time.time()
+            if self.t_start is None:
+                self.t_start = (now, self.timestamp)
+            else:
+                wait = (self.timestamp - self.t_start[1]) - (now - self.t_start[0])
+                if wait > 0:
+                    time.sleep(wait)
+
+        return np.array(record['frame'], dtype=np.float)
+
+    def __iter__(self):
+        while True:
+            try:
+                yield self.scan_frames()
+            except EOFError:
+                return
+
+
+def record(path, seconds=None, compress=False, setrate=2000):
+    # record frames from the first Morph until the time is up or ctrl-c
+    import sensel_control as sc
+
+    handle, info = sc.open_sensel()
+    frame = sc.init_frame(handle, setrate=setrate, baseline=0)
+    recorder = FrameRecorder(path, info.num_rows, info.num_cols, compress=compress)
+    t_start = time.time()
+    try:
+        while seconds is None or time.time() - t_start < seconds:
+            sc.scan_frames(handle, frame, info, recorder=recorder)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        recorder.close()
+        sc.close_sensel(handle, frame)
+    print('Recorded %d frames to %s' % (recorder.numFrames, path))
+
+
+def describe(path):
+    # print frame count, duration and lost frames of a recording
+    with open(path, 'rb') as f:
+        rows, cols, flags = readHeader(f)
+    numFrames = 0
+    lost = 0
+    t_first = t_last = None
+    for chunk in readChunks(path):
+        numFrames += len(chunk)
+        lost += int(np.sum(chunk['lost']))
+        if t_first is None:
+            t_first = chunk['timestamp'][0]
+        t_last = chunk['timestamp'][-1]
+    duration = 0 if t_first is None else t_last - t_first
+    print('%s: %d x %d, %s' % (path, rows, cols, 'compressed' if flags & FLAG_COMPRESSED else 'uncompressed'))
+    print('%d frames, %.1f s, %d lost frames' % (numFrames, duration, lost))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Record and inspect Morph force frame recordings')
+    subparsers = parser.add_subparsers(dest='command')
+    parser_record = subparsers.add_parser('record', help='record frames from the Morph')
+    parser_record.add_argument('path')
+    parser_record.add_argument('--seconds', type=float, default=None, help='stop after this time')
+    parser_record.add_argument('--compress', action='store_true', help='zlib compress the chunks')
+    parser_record.add_argument('--rate', type=int, default=2000, help='max frame rate of the Morph')
+    parser_info = subparsers.add_parser('info', help='describe a recording')
+    parser_info.add_argument('path')
+    parser_decompress = subparsers.add_parser('decompress', help='convert to a memory-mappable recording')
+    parser_decompress.add_argument('src')
+    parser_decompress.add_argument('dst')
+    args = parser.parse_args(argv)
+
+    if args.command == 'record':
+        record(args.path, args.seconds, args.compress, args.rate)
+    elif args.command == 'info':
+        describe(args.path)
+    elif args.command == 'decompress':
+        decompress(args.src, args.dst)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -17,11 +17,10 @@ from pyqtgraph.ptime import time
 
 import cv2
 
-import copy
-
 import sensel_control as sc
 
 import forcestamp
+import timing
 
 # def sendOSC(msg, address):
 #         msgStruct = osc_message_builder.OscMessageBuilder(address=address)
@@ -97,23 +96,30 @@ BlobTracker = forcestamp.TrackBlobs()
 marker_radii = [55 / 2 / 1.25, 17 / 1.25, 20]
 MarkerTracker = forcestamp.TrackMarkers(radii=marker_radii)
 
+# scratch images reused across frames
+blobBuffers = forcestamp.BlobBuffers((cols, rows))
+showScratch = np.zeros((cols, rows))
+showGray = np.zeros((cols, rows), dtype=np.uint8)
+showRGB = np.zeros((cols, rows, 3), dtype=np.uint8)
+
 
 def update():
     global lastTime, fps, info, handle, frame
-    try:
-        f_image = sc.scan_frames(handle, frame, info)
-    except UnboundLocalError:
-        sc.close_sensel(handle, frame)
-        # Sensel initialization
-        handle, info = sc.open_sensel()
-        # Initalize frame
-        frame = sc.init_frame(handle, detail=0, baseline=0)
-        f_image = sc.scan_frames(handle, frame, info)
+    with timing.timer.span('acquisition'):
+        try:
+            f_image = sc.scan_frames(handle, frame, info)
+        except UnboundLocalError:
+            sc.close_sensel(handle, frame)
+            # Sensel initialization
+            handle, info = sc.open_sensel()
+            # Initalize frame
+            frame = sc.init_frame(handle, detail=0, baseline=0)
+            f_image = sc.scan_frames(handle, frame, info)
 
     # print(np.max(f_image))
 
     # find blobs from the image
-    blobs, contours, hierarchy, areas, cx, cy, forces, f_image_thre = forcestamp.detectBlobs(f_image, areaThreshold=1000)
+    blobs, contours, hierarchy, areas, cx, cy, forces, f_image_thre = forcestamp.detectBlobs(f_image, areaThreshold=1000, buffers=blobBuffers)
     # print(contours)
 
     # update blob information
@@ -123,11 +129,15 @@ def update():
     MarkerTracker.update(f_image, blobs)
 
     # prepare image to show
-    f_image_show = copy.deepcopy(f_image)
-    if np.max(f_image_show) > 0:
-        f_image_show = f_image_show / np.max(f_image_show) * 255
-    f_image_show = cv2.cvtColor(f_image_show.astype(np.uint8),
-                                cv2.COLOR_GRAY2RGB
+    peak = np.max(f_image)
+    if peak > 0:
+        np.multiply(f_image, 255.0 / peak, out=showScratch)
+    else:
+        showScratch.fill(0)
+    np.copyto(showGray, showScratch, casting='unsafe')
+    f_image_show = cv2.cvtColor(showGray,
+                                cv2.COLOR_GRAY2RGB,
+                                dst=showRGB
                                 )
 
     # f_image_thre = np.zeros((cols, rows), dtype=np.uint8)
@@ -313,6 +323,7 @@ def update():
         fps = fps * (1 - s) + (1.0 / dt) * s
 
     # print('%0.2f fps' % fps)
+    timing.timer.endFrame()
     QtGui.QApplication.processEvents()
 
 
@@ -325,4 +336,6 @@ if __name__ == "__main__":
     if (sys.flags.interactive != 1) or not hasattr(QtCore, 'PYQT_VERSION'):
         QtGui.QApplication.instance().exec_()
         print('Closed the window')
+        if timing.timer.enabled:
+            print(timing.timer.report())
         sc.close_sensel(handle, frame)
@@ -8,6 +8,7 @@ except NameError:
     pass
 
 import sys
+import time
 sys.path.append('sensel-lib-python')
 import sensel
 import numpy as np
@@ -74,7 +75,8 @@ def init_frame(handle, setrate=125, detail=0, baseline=1, devbuffer=10):
     return frame
 
 
-def scan_frames(handle, frame, info):
+def scan_frames(handle, frame, info, recorder=None):
+    # recorder: optional recording.FrameRecorder storing every frame read
     error = sensel.readSensor(handle)
     error, num_frames = sensel.getNumAvailableFrames(handle)
     # print('Available num frames:', num_frames)
@@ -83,6 +85,8 @@ def scan_frames(handle, frame, info):
         error = sensel.getFrame(handle, frame)
         # print('Content bit mask: ', frame.content_bit_mask)
         f_image = print_frame(frame, info)
+        if recorder is not None:
+            recorder.write(f_image, time.time(), frame.lost_frame_count)
     return f_image
 
 
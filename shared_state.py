@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+
+"""Marker state in shared memory for consumers on the same host
+
+    Segment layout (version 1)
+    --------------------------
+    header (HEADER_DTYPE, 64 bytes): magic, version, capacities and record sizes,
+        seq, frame, timestamp, numMarkers, numBlobs
+    markers: maxMarkers records of output.MARKER_DTYPE
+    blobs: maxBlobs records of output.BLOB_DTYPE
+
+    The publisher guards every frame with a seqlock: seq is odd while a frame
+    is written and even once it is complete. Readers copy the frame and retry
+    when seq was odd or changed during the copy, so they never see a torn frame
+    and never block the publisher.
+
+    Usage
+    -----
+    publisher = SharedStatePublisher('forcestamp')   # in the pipeline, as an output
+    publisher.send(markers, blobs, timestamp)
+
+    reader = SharedStateReader('forcestamp')         # in the consumer
+    frame, timestamp, markers, blobs = reader.read()
+
+    python shared_state.py forcestamp                # print the markers of a running publisher
+"""
+
+from __future__ import print_function
+
+import argparse
+import sys
+import time
+
+import numpy as np
+from multiprocessing import shared_memory
+
+import output
+
+MAGIC = b'FSTAMPSM'
+VERSION = 1
+
+HEADER_DTYPE = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u4'),
+    ('maxMarkers', '<u4'),
+    ('maxBlobs', '<u4'),
+    ('markerSize', '<u4'),
+    ('blobSize', '<u4'),
+    ('reserved', '<u4'),
+    ('seq', '<u8'),
+    ('frame', '<u8'),
+    ('timestamp', '<f8'),
+    ('numMarkers', '<u4'),
+    ('numBlobs', '<u4'),
+])
+HEADER_SIZE = 64
+
+
+def segmentSize(maxMarkers, maxBlobs):
+    return HEADER_SIZE + maxMarkers * output.MARKER_DTYPE.itemsize + maxBlobs * output.BLOB_DTYPE.itemsize
+
+
+def headerField(buf, name, fmt):
+    # one header field as a memoryview of a single item, much faster to access than numpy fields
+    offset = HEADER_DTYPE.fields[name][1]
+    return buf[offset:offset + HEADER_DTYPE.fields[name][0].itemsize].cast(fmt)
+
+
+def blobOffset(maxMarkers):
+    return HEADER_SIZE + maxMarkers * output.MARKER_DTYPE.itemsize
+
+
+class _FrameFields:
+    # per frame header fields of a segment
+
+    def __init__(self, buf):
+        self.seq = headerField(buf, 'seq', 'Q')
+        self.frame = headerField(buf, 'frame', 'Q')
+        self.timestamp = headerField(buf, 'timestamp', 'd')
+        self.numMarkers = headerField(buf, 'numMarkers', 'I')
+        self.numBlobs = headerField(buf, 'numBlobs', 'I')
+
+    def release(self):
+        for view in (self.seq, self.frame, self.timestamp, self.numMarkers, self.numBlobs):
+            view.release()
+
+
+class SharedStatePublisher:
+    # writes the markers and blobs of every frame into a shared memory segment
+    # name: segment name. an existing segment of the same name is replaced
+    # maxMarkers, maxBlobs: capacity. extra markers or blobs of a frame are not published
+    # works as a pipeline output: send(markers, blobs, timestamp)
+
+    def __init__(self, name='forcestamp', maxMarkers=32, maxBlobs=256):
+        self.name = name
+        self.maxMarkers = maxMarkers
+        self.maxBlobs = maxBlobs
+
+        size = segmentSize(maxMarkers, maxBlobs)
+        try:
+            self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            # left over from a publisher which did not close
+            stale = shared_memory.SharedMemory(name)
+            stale.close()
+            stale.unlink()
+            self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+
+        self.header = np.ndarray(1, dtype=HEADER_DTYPE, buffer=self.shm.buf)[0]
+        self.header['maxMarkers'] = maxMarkers
+        self.header['maxBlobs'] = maxBlobs
+        self.header['markerSize'] = output.MARKER_DTYPE.itemsize
+        self.header['blobSize'] = output.BLOB_DTYPE.itemsize
+        self.header['seq'] = 0
+        self.header['frame'] = 0
+        self.header['version'] = VERSION
+        # readers check the magic last, once the layout is complete
+        self.header['magic'] = MAGIC
+        self.fields = _FrameFields(self.shm.buf)
+        self.blobOffset = blobOffset(maxMarkers)
+
+        self.numFrames = 0
+
+    def send(self, markers, blobs=(), timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        if not isinstance(markers, np.ndarray):
+            markers = output.markerRecords(markers)
+        if blobs is None:
+            blobs = ()
+        if not isinstance(blobs, np.ndarray):
+            blobs = output.blobRecords(blobs)
+        numMarkers = min(len(markers), self.maxMarkers)
+        numBlobs = min(len(blobs), self.maxBlobs)
+        # raw records, prepared before the frame is locked
+        markerData = np.ascontiguousarray(markers[:numMarkers], dtype=output.MARKER_DTYPE).tobytes()
+        blobData = np.ascontiguousarray(blobs[:numBlobs], dtype=output.BLOB_DTYPE).tobytes()
+
+        fields = self.fields
+        buf = self.shm.buf
+        seq = fields.seq[0]
+        fields.seq[0] = seq + 1  # odd: frame being written
+        buf[HEADER_SIZE:HEADER_SIZE + len(markerData)] = markerData
+        buf[self.blobOffset:self.blobOffset + len(blobData)] = blobData
+        fields.numMarkers[0] = numMarkers
+        fields.numBlobs[0] = numBlobs
+        fields.timestamp[0] = timestamp
+        fields.frame[0] = self.numFrames
+        fields.seq[0] = seq + 2  # even: frame complete
+        self.numFrames += 1
+
+    def close(self):
+        # remove the segment. readers keep their mapping until they close
+        if self.shm is None:
+            return
+        self.fields.release()
+        del self.header, self.fields
+        self.shm.close()
+        self.shm.unlink()
+        self.shm = None
+
+
+class SharedStateReader:
+    # reads the latest frame of a SharedStatePublisher
+    # name: segment name of the publisher
+
+    def __init__(self, name='forcestamp'):
+        self.name = name
+        try:
+            # the segment belongs to the publisher, do not unlink it when the reader exits
+            self.shm = shared_memory.SharedMemory(name, track=False)
+        except TypeError:
+            # Python < 3.13
+            self.shm = shared_memory.SharedMemory(name)
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+
+        header = np.ndarray(1, dtype=HEADER_DTYPE, buffer=self.shm.buf)[0]
+        if header['magic'] != MAGIC:
+            raise ValueError('%s is not a ForceStamp marker state segment' % name)
+        if header['version'] != VERSION:
+            raise ValueError('unsupported marker state version %d' % header['version'])
+        if header['markerSize'] != output.MARKER_DTYPE.itemsize or \
+           header['blobSize'] != output.BLOB_DTYPE.itemsize:
+            raise ValueError('marker state record layout does not match')
+        self.maxMarkers = int(header['maxMarkers'])
+        self.maxBlobs = int(header['maxBlobs'])
+        self.header = header
+        self.fields = _FrameFields(self.shm.buf)
+        self.blobOffset = blobOffset(self.maxMarkers)
+
+    def seq(self):
+        # changes whenever a new frame is published
+        return self.fields.seq[0]
+
+    def read(self, timeout=0.1):
+        # consistent copy of the latest frame: (frame, timestamp, markers, blobs),
+        # None before the first frame. markers and blobs are structured arrays
+        # of output.MARKER_DTYPE and output.BLOB_DTYPE
+        fields = self.fields
+        buf = self.shm.buf
+        markerSize = output.MARKER_DTYPE.itemsize
+        blobSize = output.BLOB_DTYPE.itemsize
+        t_start = None
+        while True:
+            seq = fields.seq[0]
+            if seq == 0:
+                return None
+            if not seq & 1:
+                numMarkers = fields.numMarkers[0]
+                numBlobs = fields.numBlobs[0]
+                frame = fields.frame[0]
+                timestamp = fields.timestamp[0]
+                markerData = bytearray(buf[HEADER_SIZE:HEADER_SIZE + numMarkers * markerSize])
+                blobData = bytearray(buf[self.blobOffset:self.blobOffset + numBlobs * blobSize])
+                if fields.seq[0] == seq:
+                    return (frame, timestamp,
+                            np.frombuffer(markerData, dtype=output.MARKER_DTYPE),
+                            np.frombuffer(blobData, dtype=output.BLOB_DTYPE))
+            # frame being written, try again
+            if t_start is None:
+                t_start = time.time()
+            elif time.time() - t_start > timeout:
+                raise RuntimeError('could not read a consistent frame from %s' % self.name)
+
+    def wait(self, seq, timeout=None, interval=0.0005):
+        # wait for a frame newer than seq. returns the new seq, or None on timeout
+        t_start = time.time()
+        while True:
+            current = self.seq()
+            if current != seq and not current & 1:
+                return current
+            if timeout is not None and time.time() - t_start > timeout:
+                return None
+            time.sleep(interval)
+
+    def close(self):
+        if self.shm is None:
+            return
+        self.fields.release()
+        del self.header, self.fields
+        self.shm.close()
+        self.shm = None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Print the markers published in shared memory')
+    parser.add_argument('name', nargs='?', default='forcestamp')
+    args = parser.parse_args(argv)
+
+    reader = SharedStateReader(args.name)
+    seq = 0
+    try:
+        while True:
+            seq = reader.wait(seq)
+            state = reader.read()
+            if state is None:
+                continue
+            frame, timestamp, markers, blobs = state
+            print('frame %d: %d blobs, markers %s' % (frame, len(blobs), ', '.join(
+                '%d (%.1f, %.1f) %.0f' % (m['ID'], m['pos_x'], m['pos_y'], m['force']) for m in markers)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reader.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
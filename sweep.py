@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+
+"""Parameter sweeps over a recording with cached intermediates
+
+    Each stage of the tracking only depends on some of the parameters, so its
+    per-frame results are cached under the parameters which produced them and
+    only the stages after a changed parameter are recomputed:
+
+    peaks: local peaks of every frame with their subpixel peaks and forces
+        (no parameters)
+    contours: area of the largest blob contour covering each peak (binThreshold)
+    blobs: blob table of every frame (binThreshold, areaThreshold, forceThreshold)
+    tracked blobs: blob IDs and appearance times from TrackBlobs (same as blobs)
+    markers: TrackMarkers (blob parameters, radii, distanceTolerance), not cached
+
+    Sweeping radii and distanceTolerance therefore runs peak detection and
+    blob tracking once. The markers of every frame match pipeline.Pipeline
+    and batch.py with the same settings.
+
+    Usage
+    -----
+    python sweep.py session.fsr --distance-tolerance 0.5 1 1.5 2 --radii 22 13.6 20 12.8 --radii 20
+    python sweep.py session.fsr --area-threshold 800 1000 --force-threshold 4 6 8 --output sweep.npz
+
+    sweep = Sweep('session.fsr')
+    markers, blobs = sweep.run(batch.sweepSettings({'distanceTolerance': [1, 1.5]}))
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import sys
+import time
+
+import cv2
+import numpy as np
+
+import batch
+import forcestamp
+import parallel
+import pipeline
+import recording
+
+# local peaks of a frame, in the order detectBlobs finds them
+PEAK_DTYPE = np.dtype([
+    ('row', '<i8'), ('col', '<i8'),
+    ('sub_0', '<f8'), ('sub_1', '<f8'),
+    ('force', '<f8'),
+])
+
+# blob table with the results of TrackBlobs
+TRACKED_DTYPE = np.dtype(parallel.BLOB_TABLE_DTYPE.descr + [('ID', '<i8'), ('t_appeared', '<f8')])
+
+STAGES = ['peaks', 'contours', 'blobs', 'trackedBlobs', 'markers']
+
+
+def findPeaks(img, buffers=None):
+    # local peaks of a frame with their subpixel peaks and blob forces, as in detectBlobs
+    if np.max(img.ravel()) <= 0:
+        return np.zeros(0, dtype=PEAK_DTYPE)
+    peaks = forcestamp.findPeakCoord(forcestamp.findLocalPeaks(img, threshold=0.2, buffers=buffers))
+    table = np.zeros(len(peaks), dtype=PEAK_DTYPE)
+    for row, peak, subPeak in zip(table, peaks, forcestamp.findSubpixelPeaks(peaks, img, n=5)):
+        row['row'], row['col'] = peak
+        row['sub_0'], row['sub_1'] = subPeak
+        row['force'] = forcestamp.blobForce(img, peak)
+    return table
+
+
+def coverAreas(img, peaks, binThreshold=2, buffers=None, cover=None):
+    # area of the largest contour covering each peak, -inf outside of the contours.
+    # detectBlobs drops a peak when this is over areaThreshold
+    if len(peaks) == 0:
+        return np.zeros(0)
+    contours, hierarchy = forcestamp.findBlobContours(img, binThreshold, buffers)
+    if cover is None:
+        cover = np.zeros(img.shape)
+    cover.fill(-np.inf)
+    areas = [cv2.contourArea(cnt) for cnt in contours]
+    # larger contours are drawn last and cover smaller ones
+    for i in np.argsort(areas, kind='stable'):
+        cv2.drawContours(cover, contours, int(i), areas[i], -1)
+    return cover[peaks['row'], peaks['col']]
+
+
+def trackedBlobs(table):
+    # tracked Blob objects of a TRACKED_DTYPE table
+    blobs = parallel.tableBlobs(table)
+    for b, row in zip(blobs, table):
+        b.attributeID(int(row['ID']))
+        b.succeedTime(row['t_appeared'])
+    return blobs
+
+
+class Sweep:
+    # path: recording. frames are read again for every stage run, only the
+    # intermediates are kept in memory
+
+    def __init__(self, path):
+        self.path = path
+        self.cache = {}
+        self.timestamps = None
+
+        # stage runs, cache hits and seconds per stage, without the stages it depends on
+        self.computed = collections.Counter()
+        self.reused = collections.Counter()
+        self.durations = collections.Counter()
+        self.nested = []
+
+    def frames(self):
+        # frames and timestamps, as pipeline.Pipeline reads them from a replay
+        replay = recording.FrameReplay(self.path, realtime=False)
+        for frame in replay:
+            yield frame, float(replay.timestamp)
+
+    def stage(self, name, key, compute):
+        # per frame results of a stage, computed once per key
+        if (name, key) in self.cache:
+            self.reused[name] += 1
+            return self.cache[(name, key)]
+        t_start = time.perf_counter()
+        self.nested.append(0)
+        result = compute()
+        duration = time.perf_counter() - t_start
+        self.durations[name] += duration - self.nested.pop()
+        if self.nested:
+            self.nested[-1] += duration
+        self.computed[name] += 1
+        self.cache[(name, key)] = result
+        return result
+
+    def peaks(self):
+        def compute():
+            buffers = None
+            tables = []
+            self.timestamps = []
+            for frame, timestamp in self.frames():
+                if buffers is None:
+                    buffers = forcestamp.BlobBuffers(frame.shape, frame.dtype)
+                tables.append(findPeaks(frame, buffers))
+                self.timestamps.append(timestamp)
+            return tables
+        return self.stage('peaks', (), compute)
+
+    def contours(self, binThreshold):
+        def compute():
+            buffers = None
+            cover = None
+            areas = []
+            for (frame, timestamp), peaks in zip(self.frames(), self.peaks()):
+                if buffers is None:
+                    buffers = forcestamp.BlobBuffers(frame.shape, frame.dtype)
+                    cover = np.zeros(frame.shape)
+                areas.append(coverAreas(frame, peaks, binThreshold, buffers, cover))
+            return areas
+        return self.stage('contours', (binThreshold,), compute)
+
+    def blobs(self, binThreshold, areaThreshold, forceThreshold):
+        def compute():
+            tables = []
+            for peaks, cover in zip(self.peaks(), self.contours(binThreshold)):
+                kept = peaks[~(cover > areaThreshold) & (peaks['force'] > forceThreshold)]
+                table = np.zeros(len(kept), dtype=parallel.BLOB_TABLE_DTYPE)
+                table['cx'] = kept['col']
+                table['cy'] = kept['row']
+                table['area'] = 3 * 3
+                table['force'] = kept['force']
+                tables.append(table)
+            return tables
+        return self.stage('blobs', (binThreshold, areaThreshold, forceThreshold), compute)
+
+    def trackedBlobs(self, binThreshold, areaThreshold, forceThreshold):
+        def compute():
+            trackBlobs = forcestamp.TrackBlobs()
+            tables = []
+            blobTables = self.blobs(binThreshold, areaThreshold, forceThreshold)
+            for table, timestamp in zip(blobTables, self.timestamps):
+                blobs = trackBlobs.track(parallel.tableBlobs(table), timestamp)
+                tracked = np.zeros(len(blobs), dtype=TRACKED_DTYPE)
+                for row, b in zip(tracked, blobs):
+                    row['cx'], row['cy'], row['area'], row['force'] = b.cx, b.cy, b.area, b.force
+                    row['ID'], row['t_appeared'] = b.ID, b.t_appeared
+                tables.append(tracked)
+            return tables
+        return self.stage('trackedBlobs', (binThreshold, areaThreshold, forceThreshold), compute)
+
+    def track(self, settings, run=0):
+        """Markers and blobs of every frame for one parameter set
+
+        Args
+        ----
+        settings (dict): keyword arguments of pipeline.Pipeline
+        run (int): run index of the records
+
+        Returns
+        -------
+        markers, blobs (array): records of batch.MARKER_COLUMNS and batch.BLOB_COLUMNS
+        """
+        s = dict(batch.DEFAULTS)
+        s.update(settings)
+        tables = self.trackedBlobs(s['binThreshold'], s['areaThreshold'], s['forceThreshold'])
+
+        t_start = time.perf_counter()
+        trackMarkers = forcestamp.TrackMarkers(s.get('radii', pipeline.RADII),
+                                               distanceTolerance=s['distanceTolerance'])
+        collector = batch.FrameCollector(run)
+        for (frame, timestamp), table in zip(self.frames(), tables):
+            blobs = trackedBlobs(table)
+            trackMarkers.update(frame, blobs, timestamp)
+            collector.send(trackMarkers.markers, blobs, timestamp)
+        self.durations['markers'] += time.perf_counter() - t_start
+        self.computed['markers'] += 1
+        return collector.records()
+
+    def run(self, settings):
+        # markers and blobs of every parameter set, as batch.run
+        results = [self.track(s, i) for i, s in enumerate(settings)]
+        return (np.concatenate([markers for markers, blobs in results] or [np.zeros(0, dtype=batch.MARKER_COLUMNS)]),
+                np.concatenate([blobs for markers, blobs in results] or [np.zeros(0, dtype=batch.BLOB_COLUMNS)]))
+
+    def report(self):
+        lines = ['%-14s %8s %8s %10s' % ('stage', 'computed', 'reused', 'seconds')]
+        for name in STAGES:
+            lines.append('%-14s %8d %8d %10.2f' % (name, self.computed[name], self.reused[name], self.durations[name]))
+        return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Sweep ForceStamp tracking parameters over a recording, '
+                                                 'reusing the stages a parameter does not affect')
+    parser.add_argument('recording')
+    parser.add_argument('--output', help='write the markers and blobs of every run to this .npz file (as batch.py)')
+    parser.add_argument('--radii', type=float, nargs='+', action='append', default=None,
+                        help='marker radii, repeat to sweep several sets')
+    parser.add_argument('--area-threshold', type=float, nargs='+', default=[1000])
+    parser.add_argument('--force-threshold', type=float, nargs='+', default=[6])
+    parser.add_argument('--bin-threshold', type=float, nargs='+', default=[2])
+    parser.add_argument('--distance-tolerance', type=float, nargs='+', default=[1])
+    args = parser.parse_args(argv)
+
+    settings = batch.sweepSettings({'areaThreshold': args.area_threshold,
+                                    'forceThreshold': args.force_threshold,
+                                    'binThreshold': args.bin_threshold,
+                                    'distanceTolerance': args.distance_tolerance,
+                                    'radii': args.radii or [pipeline.RADII]})
+
+    sweep = Sweep(args.recording)
+    t_start = time.time()
+    markers, blobs = sweep.run(settings)
+    print('%d frames, %d runs in %.1f s' % (len(sweep.timestamps), len(settings), time.time() - t_start))
+    print(batch.report(markers, blobs, settings))
+    print(sweep.report())
+
+    if args.output:
+        segments = [(0, len(sweep.timestamps))]
+        batch.save(args.output, markers, blobs, settings, segments, len(sweep.timestamps), args.recording)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
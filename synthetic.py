@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+"""Synthetic Morph force frames with ForceStamp markers
+
+    Markers are rendered from the codebook of forcestamp.marker: slot k of
+    the codeword sits at phase rot + k * 2pi / 15 around the marker center,
+    with the same phase convention as marker.extractCode (x = sin, y = cos).
+    Pins and fingers are Gaussian force profiles. Frames are (rows, cols)
+    arrays indexed as frame[y, x], like the frames from sensel_control.
+"""
+
+import numpy as np
+
+import forcestamp
+
+ROWS = 105
+COLS = 185
+N_SLOTS = 15
+
+_codebook = []
+
+
+def codebook():
+    # codewords of the marker IDs, indexed by ID (ID 0 is not a valid marker)
+    if len(_codebook) == 0:
+        _codebook.extend(forcestamp.marker(20).uniqueCodes)
+    return _codebook
+
+
+class SyntheticMarker:
+    # ID: marker ID (index in codebook)
+    # pos: (x, y) center
+    # radius: pin ring radius
+    # rot: rotation (0-2pi), phase of slot 0
+    # pinForce: total force of each pin, scalar or per pin
+
+    def __init__(self, ID, pos, radius=20, rot=0, pinForce=150):
+        self.ID = ID
+        self.pos = pos
+        self.radius = radius
+        self.rot = rot
+        self.pinForce = pinForce
+
+    def pins(self):
+        # (x, y) coordinates and forces of the pins
+        code = codebook()[self.ID]
+        slots = np.where(code == 1)[0]
+        phases = self.rot + slots * 2 * np.pi / N_SLOTS
+        x = self.pos[0] + self.radius * np.sin(phases)
+        y = self.pos[1] + self.radius * np.cos(phases)
+        force = np.broadcast_to(np.asarray(self.pinForce, dtype=float), np.shape(x))
+        return x, y, force
+
+
+class SyntheticFinger:
+    # pos: (x, y) center, force: total force, sigma: spread in pixels
+
+    def __init__(self, pos, force=400, sigma=2.5):
+        self.pos = pos
+        self.force = force
+        self.sigma = sigma
+
+
+def renderGaussians(x, y, force, sigma, rows=ROWS, cols=COLS):
+    # sum of isotropic Gaussians with the given total forces, as separable outer products
+    x = np.atleast_1d(np.asarray(x, dtype=float))
+    y = np.atleast_1d(np.asarray(y, dtype=float))
+    sigma = np.broadcast_to(np.asarray(sigma, dtype=float), np.shape(x))
+    amplitude = np.asarray(force, dtype=float) / (2 * np.pi * sigma ** 2)
+    gx = np.exp(-(np.arange(cols)[None, :] - x[:, None]) ** 2 / (2 * sigma[:, None] ** 2))
+    gy = np.exp(-(np.arange(rows)[None, :] - y[:, None]) ** 2 / (2 * sigma[:, None] ** 2))
+    return np.einsum('pr,pc->rc', amplitude[:, None] * gy, gx)
+
+
+def makeFrame(markers=(), fingers=(), rows=ROWS, cols=COLS, sigma=0.8, noise=0.0, rng=None):
+    # render markers and fingers onto a force frame
+    # sigma: pin spread in pixels, noise: std of additive Gaussian noise
+    xs = []
+    ys = []
+    forces = []
+    sigmas = []
+    for mkr in markers:
+        x, y, force = mkr.pins()
+        xs.append(x)
+        ys.append(y)
+        forces.append(force)
+        sigmas.append(np.full(len(x), sigma))
+    for finger in fingers:
+        xs.append([finger.pos[0]])
+        ys.append([finger.pos[1]])
+        forces.append([finger.force])
+        sigmas.append([finger.sigma])
+
+    frame = np.zeros((rows, cols))
+    if len(xs) > 0:
+        frame += renderGaussians(np.concatenate(xs), np.concatenate(ys),
+                                 np.concatenate(forces), np.concatenate(sigmas), rows, cols)
+    if noise > 0:
+        rng = np.random.RandomState(0) if rng is None else rng
+        frame += rng.normal(0, noise, (rows, cols))
+    # the Morph does not report negative forces
+    np.maximum(frame, 0, out=frame)
+    return frame
+
+
+def randomScene(numMarkers, numFingers=0, radius=20, IDs=None, pinForce=150,
+                fingerForce=400, rows=ROWS, cols=COLS, rng=None, maxTries=1000):
+    # markers and fingers at random, non overlapping positions
+    rng = np.random.RandomState(0) if rng is None else rng
+    IDs = np.arange(1, len(codebook())) if IDs is None else IDs
+    margin = radius + 4
+
+    markers = []
+    for i in range(maxTries):
+        if len(markers) == numMarkers:
+            break
+        pos = (rng.uniform(margin, cols - margin), rng.uniform(margin, rows - margin))
+        if all(forcestamp.distance(pos, m.pos) > 2 * radius + 8 for m in markers):
+            markers.append(SyntheticMarker(rng.choice(IDs), pos, radius,
+                                           rng.uniform(0, 2 * np.pi), pinForce))
+
+    fingers = []
+    for i in range(maxTries):
+        if len(fingers) == numFingers:
+            break
+        pos = (rng.uniform(5, cols - 5), rng.uniform(5, rows - 5))
+        if all(forcestamp.distance(pos, m.pos) > radius + 6 for m in markers) and \
+           all(forcestamp.distance(pos, f.pos) > 8 for f in fingers):
+            fingers.append(SyntheticFinger(pos, fingerForce))
+
+    return markers, fingers
+
+
+def animate(markers, fingers, numFrames, speed=0.2, angularSpeed=0.02, **kwargs):
+    # frames of markers slowly moving along x and rotating.
+    # yields (frame, markers) with the ground truth state of each frame
+    for i in range(numFrames):
+        moved = [SyntheticMarker(m.ID,
+                                 (m.pos[0] + speed * np.sin(i * 0.05), m.pos[1]),
+                                 m.radius,
+                                 (m.rot + angularSpeed * i) % (2 * np.pi),
+                                 m.pinForce)
+                 for m in markers]
+        yield makeFrame(moved, fingers, **kwargs), moved
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+# the modules live at the repository root
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import output
+import recording
+import synthetic
+
+
+def writeScene(path, numSegments=2, numFrames=30, gap=25, noise=0.05, seed=3):
+    # synthetic recording of markers and fingers, with gaps of empty frames after each segment
+    rng = np.random.RandomState(seed)
+    markers, fingers = synthetic.randomScene(2, 1, radius=20, rng=rng)
+    t = 1000.0
+    with recording.FrameRecorder(path) as rec:
+        for k in range(numSegments):
+            for frame, truth in synthetic.animate(markers, fingers, numFrames, noise=noise, rng=rng):
+                rec.write(frame, t)
+                t += 1 / 200.
+            for i in range(gap):
+                rec.write(np.zeros((synthetic.ROWS, synthetic.COLS)), t)
+                t += 1 / 200.
+    return path
+
+
+@pytest.fixture(scope='session')
+def scene(tmp_path_factory):
+    return writeScene(str(tmp_path_factory.mktemp('recordings') / 'scene.fsr'))
+
+
+class FrameRecords:
+    # pipeline output keeping the marker records and tracked blobs of every frame
+
+    def __init__(self):
+        self.frames = []
+
+    def send(self, markers, blobs, timestamp):
+        self.frames.append((output.markerRecords(markers).tolist(),
+                            [(b.ID, b.cx, b.cy, b.force, b.t_appeared) for b in blobs],
+                            timestamp))
+
+    def close(self):
+        pass
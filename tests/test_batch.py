@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+
+import batch
+import pipeline
+import recording
+
+
+def singlePass(path, settings, run=0):
+    # records of one pipeline over the whole recording
+    collector = batch.FrameCollector(run)
+    p = pipeline.Pipeline(recording.FrameReplay(path, realtime=False), [collector], **settings)
+    p.run()
+    return collector.records()
+
+
+def test_segments_split_after_gaps():
+    maxima = np.array([9, 9, 0, 0, 0, 9, 0, 0, 9], dtype=np.float)
+    assert batch.findSegments(maxima, forceThreshold=6, minGap=2) == [(0, 4), (4, 8), (8, 9)]
+    assert batch.findSegments(maxima, forceThreshold=6, minGap=4) == [(0, 9)]
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_run_matches_single_pass(scene, workers):
+    settings = batch.sweepSettings({'forceThreshold': [6, 8], 'distanceTolerance': [1, 1.5]})
+    markers, blobs, segments, numFrames = batch.run(scene, settings, workers)
+
+    # each gap splits the recording, so the segments are tracked by separate pipelines
+    assert segments == [(0, 50), (50, 105), (105, 110)]
+    assert numFrames == 110
+
+    for i, s in enumerate(settings):
+        expectedMarkers, expectedBlobs = singlePass(scene, s, i)
+        assert np.any(expectedMarkers['ID'] > 0)
+        np.testing.assert_array_equal(markers[markers['run'] == i], expectedMarkers)
+        np.testing.assert_array_equal(blobs[blobs['run'] == i], expectedBlobs)
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+import parallel
+import pipeline
+import recording
+
+from conftest import FrameRecords
+
+
+def track(path, cls, **kwargs):
+    records = FrameRecords()
+    p = cls(recording.FrameReplay(path, realtime=False), [records], **kwargs)
+    try:
+        p.run()
+    finally:
+        p.close()
+    return records.frames
+
+
+@pytest.mark.parametrize('workers, slots', [(1, None), (2, None), (2, 1)])
+def test_parallel_matches_serial(scene, workers, slots):
+    serial = track(scene, pipeline.Pipeline)
+    # the scene has recognized markers
+    assert any(m[0] > 0 for markers, blobs, t in serial for m in markers)
+    assert track(scene, parallel.ParallelPipeline, workers=workers, slots=slots) == serial
+
+
+def test_close_with_frames_in_flight(scene):
+    p = parallel.ParallelPipeline(recording.FrameReplay(scene, realtime=False), workers=2)
+    p.run(maxFrames=10)
+    p.close()
+    assert p.numFrames == 10
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+import batch
+import sweep
+
+
+def test_sweep_matches_batch(scene):
+    settings = batch.sweepSettings({'areaThreshold': [800, 1000],
+                                    'forceThreshold': [6, 8],
+                                    'distanceTolerance': [1, 1.5],
+                                    'radii': [[22, 13.6, 20, 12.8], [20]]})
+    s = sweep.Sweep(scene)
+    markers, blobs = s.run(settings)
+    expectedMarkers, expectedBlobs, segments, numFrames = batch.run(scene, settings, workers=0)
+
+    assert np.any(markers['ID'] > 0)
+    np.testing.assert_array_equal(markers, expectedMarkers)
+    np.testing.assert_array_equal(blobs, expectedBlobs)
+
+    # peaks once, contours and blobs once per parameter set they depend on
+    assert s.computed['peaks'] == 1
+    assert s.computed['contours'] == 1
+    assert s.computed['blobs'] == 4
+    assert s.computed['markers'] == len(settings)
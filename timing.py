@@ -0,0 +1,161 @@
+"""Per-frame timing of the detection pipeline
+
+    Named spans record their duration into a preallocated ring of frames.
+    Timing is off by default; a disabled timer returns a shared no-op span,
+    so the instrumented code only pays for one method call per span.
+    Set the FORCESTAMP_TIMING environment variable or call timer.enable()
+    to turn it on.
+
+    Usage
+    -----
+    with timing.timer.span('findMarker'):
+        markers, blobs = findMarker(blobs)
+    timing.timer.endFrame()
+    print(timing.timer.report())
+
+    Spans are inclusive (a span around TrackBlobs.update also contains the
+    spans of detectBlobs), and a span entered several times in one frame
+    (e.g. marker.update for each marker) accumulates its durations.
+"""
+
+import os
+import time
+
+import numpy as np
+
+
+class _NullSpan:
+    # span of a disabled timer
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ('timer', 'index', 't_start')
+
+    def __init__(self, timer, index):
+        self.timer = timer
+        self.index = index
+        self.t_start = 0
+
+    def __enter__(self):
+        self.t_start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.timer.record(self.index, time.perf_counter() - self.t_start)
+        return False
+
+
+class FrameTimer:
+    # capacity: number of frames kept in the ring
+    # maxSpans: number of span columns allocated up front
+
+    def __init__(self, capacity=1000, maxSpans=32, enabled=False):
+        self.capacity = capacity
+        self.enabled = enabled
+
+        self.names = []
+        self.spans = {}
+
+        # durations in seconds, nan when the span did not run in the frame
+        self.durations = np.full((capacity, maxSpans), np.nan)
+        self.frame = 0  # ring index of the current frame
+        self.numFrames = 0  # number of completed frames
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        self.durations[:] = np.nan
+        self.frame = 0
+        self.numFrames = 0
+
+    def span(self, name):
+        if not self.enabled:
+            return _NULL_SPAN
+        span = self.spans.get(name)
+        if span is None:
+            span = self.spans[name] = _Span(self, self.register(name))
+        return span
+
+    def register(self, name):
+        # column index of a span name
+        if name in self.names:
+            return self.names.index(name)
+        self.names.append(name)
+        if len(self.names) > np.shape(self.durations)[1]:
+            extra = np.full((self.capacity, np.shape(self.durations)[1]), np.nan)
+            self.durations = np.hstack((self.durations, extra))
+        return len(self.names) - 1
+
+    def record(self, index, duration):
+        # add a duration to the current frame. index: column from register
+        current = self.durations[self.frame, index]
+        if current != current:  # nan
+            self.durations[self.frame, index] = duration
+        else:
+            self.durations[self.frame, index] = current + duration
+
+    def frameDurations(self):
+        # {name: duration} of the spans recorded in the current frame so far
+        row = self.durations[self.frame, :len(self.names)].tolist()
+        return dict((name, value) for name, value in zip(self.names, row) if value == value)
+
+    def add(self, durations):
+        # add {name: duration} measured elsewhere (e.g. in a worker process) to the current frame
+        if not self.enabled:
+            return
+        for name, duration in durations.items():
+            self.record(self.register(name), duration)
+
+    def endFrame(self):
+        # close the current frame and clear the next slot of the ring
+        if not self.enabled:
+            return
+        self.numFrames += 1
+        self.frame = self.numFrames % self.capacity
+        self.durations[self.frame] = np.nan
+
+    def completedFrames(self):
+        # durations of the completed frames in the ring, oldest first
+        count = min(self.numFrames, self.capacity - 1)
+        rows = (np.arange(self.numFrames - count, self.numFrames)) % self.capacity
+        return self.durations[rows, :len(self.names)]
+
+    def summary(self, percentiles=(50, 95, 99)):
+        # per span statistics in milliseconds over the frames where the span ran
+        frames = self.completedFrames() * 1000
+        result = {}
+        for i, name in enumerate(self.names):
+            values = frames[:, i]
+            values = values[np.isfinite(values)]
+            if len(values) == 0:
+                continue
+            stats = {'count': len(values), 'mean': np.mean(values), 'max': np.max(values)}
+            for p, value in zip(percentiles, np.percentile(values, percentiles)):
+                stats['p%d' % p] = value
+            result[name] = stats
+        return result
+
+    def report(self):
+        # summary as a text table
+        lines = ['%-24s %8s %8s %8s %8s %8s' % ('span [ms]', 'count', 'mean', 'p50', 'p95', 'p99')]
+        for name, stats in self.summary().items():
+            lines.append('%-24s %8d %8.3f %8.3f %8.3f %8.3f' % (
+                name, stats['count'], stats['mean'], stats['p50'], stats['p95'], stats['p99']))
+        return '\n'.join(lines)
+
+
+# shared timer used by the pipeline modules
+timer = FrameTimer(enabled=bool(os.environ.get('FORCESTAMP_TIMING')))